@@ -2,6 +2,8 @@ import discord
 from discord.ext import commands
 from cogs.utils.helpers import *
 from cogs.utils.clip import *
+from cogs.utils.loudness import measure_loudness, get_clipfiles
+from cogs.utils.clipresolver import ClipResolver
 from __main__ import settings, botdata, report_error
 from cogs.utils import checks
 import asyncio
@@ -10,7 +12,6 @@ import string
 import queue
 import random
 import re
-import urllib.request
 from random import randint
 from .mangocog import *
 from ctypes.util import find_library
@@ -44,11 +45,33 @@ def get_playlist(clipdir):
 	clips.sort()
 	return clips
 
-def remove_if_temp(mp3name):
-	if os.path.isfile(mp3name):
-		if os.path.dirname(mp3name) == settings.resource("temp"):
-			os.remove(mp3name)
-			print("removed temp file " + mp3name)
+# removes any files left over in the temp directory, like the ones left behind if we crashed
+def clean_temp_dir():
+	tempdir = settings.resource("temp")
+	if not os.path.isdir(tempdir):
+		return
+	for file in os.listdir(tempdir):
+		filename = os.path.join(tempdir, file)
+		if os.path.isfile(filename):
+			os.remove(filename)
+			print("removed temp file " + filename)
+
+
+max_announced_names = 4
+# how long to wait before saving newly measured clip gains, in seconds
+gains_save_delay = 30
+
+class VoiceAnnouncement:
+	"""A group of members that joined or left a voice channel at about the same time"""
+	def __init__(self, channel, is_join):
+		self.channel = channel
+		self.is_join = is_join
+		self.members = []
+
+	# how long to wait for more members before announcing
+	@property
+	def delay(self):
+		return 3 if self.is_join else 1
 
 
 class AudioPlayer:
@@ -59,10 +82,11 @@ class AudioPlayer:
 		self.player = None
 		self.clipqueue = queue.Queue()
 		self.last_clip = None
+		self.channel_id = None # kept up to date by the Audio cog's channel registry
 
 	@property
 	def voice(self):
-		return next((voice for voice in self.bot.voice_clients if voice.guild == self.guild), None)
+		return self.guild.voice_client
 
 	@property
 	def voice_channel(self):
@@ -96,14 +120,14 @@ class AudioPlayer:
 	# plays the next clip in the queue
 	def play_next_clip(self):
 		clip = self.next_clip()
-		self.voice.play(discord.FFmpegPCMAudio(clip.audiopath), after=lambda e: self.done_talking(e))
-		self.voice.source = discord.PCMVolumeTransformer(self.voice.source)
-		self.voice.source.volume = clip.volume
-		print("playing: " + clip.audiopath)
-		if self.last_clip != None and clip.audiopath != self.last_clip.audiopath:
-			remove_if_temp(self.last_clip.audiopath)
+		self.voice.play(clip.create_source(self.clip_measured), after=lambda e: self.done_talking(e))
+		print("playing: " + clip.clipid)
 		self.last_clip = clip
 
+	# called from ffmpeg's thread when a clip that hadn't been measured yet has been measured while it played
+	def clip_measured(self, audiopath, loudness):
+		self.bot.loop.call_soon_threadsafe(lambda: self.bot.get_cog("Audio").set_clip_loudness(audiopath, loudness))
+
 	# try queueing an mp3 to play
 	async def queue_clip(self, clip, ctx):
 		if(self.voice is None):
@@ -125,8 +149,16 @@ class Audio(MangoCog):
 
 	def __init__(self, bot):
 		MangoCog.__init__(self, bot)
-		self.audioplayers = []
+		self.audioplayers = {} # guild id -> AudioPlayer
+		self.channel_audioplayers = {} # voice channel id -> AudioPlayer
+		self.member_channels = {} # user id -> voice channel id
+		self.analyzing_clips = set()
+		self.gains_save_task = None
+		self.announcements = {} # (voice channel id, is_join) -> VoiceAnnouncement
 		self.local_clipinfo = self.init_local_clipinfo()
+		self.clip_resolver = self.init_clip_resolver()
+		clean_temp_dir()
+		self.bot.loop.create_task(self.analyze_local_clips())
 
 	def init_local_clipinfo(self):
 		infofile = settings.resource("clips/clipinfo.json")
@@ -136,6 +168,60 @@ class Audio(MangoCog):
 			return {}
 		return read_json(infofile)
 
+	# the index used by smarttts. the chat wheel sounds and responses are added by the dotabase cog,
+	# here if it is already loaded (like when this cog is reloaded), and otherwise when it loads
+	# priorities: local clips = 0, chat wheel = 1, dota responses = 2
+	def init_clip_resolver(self):
+		resolver = ClipResolver()
+		for clipfile in get_clipfiles(settings.resource("clips/")):
+			clipname = os.path.basename(clipfile)[:-4]
+			resolver.add(clipname, f"local:{clipname}", 0)
+		for clipname in self.local_clipinfo:
+			resolver.add(clipname, f"local:{clipname}", 0)
+		dotabase = self.bot.get_cog("Dotabase")
+		if dotabase:
+			dotabase.add_to_clip_resolver(resolver)
+		return resolver
+
+	# measures the loudness of a local clip in the background, so that it is normalized from then on
+	# clips that are played before this gets to them are measured as they play instead (see Clip.create_source)
+	async def analyze_clip(self, audiopath):
+		if audiopath in self.analyzing_clips:
+			return
+		self.analyzing_clips.add(audiopath)
+		try:
+			loudness = await self.bot.loop.run_in_executor(None, measure_loudness, audiopath)
+			self.set_clip_loudness(audiopath, loudness)
+		finally:
+			self.analyzing_clips.remove(audiopath)
+
+	# keeps the measured loudness of a clip. the gains of local clips are saved a little later
+	def set_clip_loudness(self, audiopath, loudness):
+		clip_gains.set_loudness(audiopath, loudness, save=False)
+		if clip_gains.dirty:
+			self.save_clip_gains_later()
+
+	# saves the clip gains after a delay, so that clips measured around the same time are saved together
+	# the file is written in an executor so that it doesn't block the loop
+	def save_clip_gains_later(self):
+		if self.gains_save_task is not None and not self.gains_save_task.done():
+			return
+		async def save():
+			while clip_gains.dirty:
+				await asyncio.sleep(gains_save_delay)
+				gains = dict(clip_gains.gains)
+				clip_gains.dirty = False
+				await self.bot.loop.run_in_executor(None, write_json, clip_gains.filename, gains)
+		self.gains_save_task = self.bot.loop.create_task(save())
+
+	# measures any local clips that were added since the last offline loudness pass
+	async def analyze_local_clips(self):
+		clipfiles = [ f for f in get_clipfiles(settings.resource("clips/")) if f not in clip_gains ]
+		for clipfile in clipfiles:
+			await self.analyze_clip(clipfile)
+		if clipfiles:
+			print(f"measured loudness of {len(clipfiles)} local clips")
+
 	# gets the audioplayer for the current guild/channel/context
 	async def audioplayer(self, ctx, error_on_none=True):
 		# TODO: ACCOUNT FOR WHEN THIS MESSAGE IS A PM
@@ -147,12 +233,12 @@ class Audio(MangoCog):
 
 		if isinstance(ctx, discord.User):
 			author = ctx
-			for audioplayer in self.audioplayers:
+			audioplayer = self.channel_audioplayers.get(self.member_channels.get(author.id))
+			if audioplayer is not None:
 				member = audioplayer.guild.get_member(author.id)
-				if member and member.voice and audioplayer.voice and audioplayer.voice.channel.id == member.voice.channel.id:
-					if botdata.guildinfo(audioplayer.guild).is_banned(member):
-						raise AudioPlayerNotFoundError("Nice try, but you're banned in the voice channel that I'm in")
-					return audioplayer
+				if member and botdata.guildinfo(audioplayer.guild).is_banned(member):
+					raise AudioPlayerNotFoundError("Nice try, but you're banned in the voice channel that I'm in")
+				return audioplayer
 			if error_on_none:
 				raise AudioPlayerNotFoundError("You're not in any voice channels that I'm in")
 			else:
@@ -164,15 +250,32 @@ class Audio(MangoCog):
 		else:
 			raise ValueError(f"Incorrect type '{type(ctx)}' given to audioplayer function")
 
-		for audioplayer in self.audioplayers:
-			if audioplayer.guild == guild:
-				return audioplayer
+		audioplayer = self.audioplayers.get(guild.id)
+		if audioplayer is not None:
+			return audioplayer
 
 		if error_on_none:
 			raise AudioPlayerNotFoundError(f"I'm not in a voice channel on this server/guild. Have an admin do `{self.bot.command_prefix}summon` to put me in one.")
 		else:
 			return None
 
+	# updates the channel registry to reflect which voice channel the audioplayer is in
+	def register_channel(self, audioplayer, channel):
+		if audioplayer.channel_id is not None:
+			self.channel_audioplayers.pop(audioplayer.channel_id, None)
+		audioplayer.channel_id = channel.id if channel is not None else None
+		if channel is not None:
+			self.channel_audioplayers[channel.id] = audioplayer
+			for member in channel.members:
+				self.member_channels[member.id] = channel.id
+
+	# keeps track of which voice channel each user is in, so we can find their audioplayer from a DM
+	def update_member_channel(self, member, channel):
+		if channel is None:
+			self.member_channels.pop(member.id, None)
+		else:
+			self.member_channels[member.id] = channel.id
+
 	# Connects an audioplayer for the correct guild to the indicated channel
 	async def connect_voice(self, channel):
 		if not isinstance(channel, discord.abc.GuildChannel):
@@ -187,13 +290,15 @@ class Audio(MangoCog):
 		else:
 			audioplayer = AudioPlayer(self.bot, channel.guild)
 			await audioplayer.connect(channel)
-			self.audioplayers.append(audioplayer)
+			self.audioplayers[channel.guild.id] = audioplayer
+		self.register_channel(audioplayer, channel)
 
 	async def disconnect(self, guild):
 		audioplayer = await self.audioplayer(guild)
 		if audioplayer is not None:
 			await audioplayer.voice.disconnect()
-			self.audioplayers.remove(audioplayer)
+			self.register_channel(audioplayer, None)
+			del self.audioplayers[guild.id]
 
 	@commands.command()
 	async def play(self, ctx, *, clip : str):
@@ -299,7 +404,6 @@ class Audio(MangoCog):
 			await ctx.send("Nobody said anythin' yet")
 			return
 
-		# If its not a temp file
 		await ctx.send("Replaying " + last_clip.clipid)
 		await self.play_clip(last_clip, ctx)
 
@@ -336,19 +440,17 @@ class Audio(MangoCog):
 		if filename == "" or len(filename) > 32:
 			filename = clip.type()
 
-		filename += os.path.splitext(clip.audiopath)[1]
+		filename += clip.extension
 
 		content = f"ClipID: **{clip.clipid}**"
 		clip_info = await clip.get_info()
 		if clip_info != "":
 			content += f"\n\n{clip_info}"
 
+		fp = clip.open_audio()
 		try:
-			await ctx.send(content, file=discord.File(clip.audiopath, filename=filename))
-		except FileNotFoundError as e:
-			# The file is probably actually a url
-			fp = urllib.request.urlopen(clip.audiopath)
 			await ctx.send(content, file=discord.File(fp, filename=filename))
+		finally:
 			fp.close()
 
 
@@ -481,31 +583,19 @@ class Audio(MangoCog):
 	async def smarttts(self, ctx, *, message : str):
 		"""Automatically find the best fit for the tts given
 
-		First checks local clips (like `{cmdpfx}play`), then checks to see if it is an mp3/wav url, then checks if it's a dota chatwheel message, then checks if there is an exact match for a dota response clip, and if none of the above is found, does a simple tts clip"""
+		First checks to see if it is an mp3/wav url, then checks local clips (like `{cmdpfx}play`), then checks if it's a dota chatwheel message, then checks if there is an exact match for a dota response clip, and if none of the above is found, does a simple tts clip"""
 		await self.do_smarttts(message, ctx)
 
 	async def do_smarttts(self, message, ctx):
 		if message == "" or not message:
 			return # dont say anything if theres nothin to be said
-		simple_message = re.sub(r'[^a-z0-9\s_]', r'', message.lower())
-		try:
-			await self.play_clip(f"local:{simple_message}", ctx)
-			return # Clip played successfully so we're done
-		except ClipNotFound:
-			pass
 		if re.match(r'^https?://.*\.(mp3|wav)$', message):
 			await self.play_clip(f"url:{message}", ctx)
 			return
-		dotabase = self.bot.get_cog("Dotabase")
-		if dotabase:
-			clip = dotabase.get_chatwheel_sound_clip(message)
-			if clip:
-				await self.play_clip(clip, ctx)
-				return
-			query = await dotabase.smart_dota_query(message.split(" "), [], exact=True)
-			if query:
-				await dotabase.play_response_query(query, ctx)
-				return
+		clipid = self.clip_resolver.resolve(message)
+		if clipid:
+			await self.play_clip(clipid, ctx)
+			return
 		await self.do_tts(message, ctx)
 
 	async def on_message(self, message):
@@ -548,39 +638,80 @@ class Audio(MangoCog):
 			return # ignore bots except for mahself
 		if before and after and before.channel == after.channel:
 			return # if the member didnt change channels, dont worry about it
+		self.update_member_channel(member, after.channel if after else None)
+		if member.id == self.bot.user.id:
+			audioplayer = self.audioplayers.get(member.guild.id)
+			if audioplayer is not None:
+				self.register_channel(audioplayer, after.channel if after else None)
 		if before and before.channel and botdata.guildinfo(before.channel.guild).outros:
-			beforeplayer = await self.audioplayer(before.channel, error_on_none=False)
-			if beforeplayer is not None and beforeplayer.voice.channel.id == before.channel.id:
-				text = (await self.fix_name(member.name)) + " has left!"
-				print(text)
-				outroclip = "local:farewell"
-
-				userinfo = botdata.userinfo(member.id)
-				if userinfo.outro != "" and userinfo.outro != outroclip:
-					outroclip = userinfo.outro
-
-				await asyncio.sleep(0.5)
-				await self.play_clip(outroclip, before.channel)
-				await self.play_clip("tts:" + text, before.channel)
+			if before.channel.id in self.channel_audioplayers:
+				print(member.name + " left the channel")
+				await self.announce(member, before.channel, is_join=False)
 		if after and after.channel and botdata.guildinfo(after.channel.guild).intros:
-			afterplayer = await self.audioplayer(after.channel, error_on_none=False)
-			if afterplayer is not None and afterplayer.voice.channel.id == after.channel.id:
+			if after.channel.id in self.channel_audioplayers:
 				if member.id == self.bot.user.id:
 					botdata.guildinfo(after.channel.guild.id).voicechannel = after.channel.id
+				print(member.name + " joined the channel")
+				await self.announce(member, after.channel, is_join=True)
+
+	# adds the member to the announcement for this channel, starting a new one if there isn't one waiting
+	# this way a bunch of people joining at once get one announcement instead of one each
+	async def announce(self, member, channel, is_join):
+		key = (channel.id, is_join)
+		announcement = self.announcements.get(key)
+		if announcement is not None:
+			if member not in announcement.members:
+				announcement.members.append(member)
+			return
 
-				text = await self.fix_name(member.name)
-				print(text + " joined the channel")
-				introclip = "local:helloits"
-
-				userinfo = botdata.userinfo(member.id)
-				if userinfo.intro != "" and userinfo.intro != introclip:
-					introclip = userinfo.intro
+		announcement = VoiceAnnouncement(channel, is_join)
+		announcement.members.append(member)
+		self.announcements[key] = announcement
+		try:
+			await asyncio.sleep(announcement.delay)
+		finally:
+			del self.announcements[key]
+
+		if channel.id not in self.channel_audioplayers:
+			return # we left the channel while waiting
+		clip, text = await self.get_announcement(announcement)
+		await self.play_clip(clip, channel)
+		await self.play_clip("tts:" + text, channel)
+
+	# gets the clip and tts text to announce the given members with
+	async def get_announcement(self, announcement):
+		members = announcement.members
+		if announcement.is_join:
+			clip = "local:helloits"
+			text = await self.get_names_text(members)
+			if len(members) == 1:
+				userinfo = botdata.userinfo(members[0].id)
+				if userinfo.intro != "" and userinfo.intro != clip:
+					clip = userinfo.intro
 					text = "its " + text
-
-				await asyncio.sleep(3)
-				await self.play_clip(introclip, after.channel)
-				await self.play_clip("tts:" + text, after.channel)
-
+		else:
+			clip = "local:farewell"
+			text = await self.get_names_text(members)
+			if len(members) == 1:
+				text += " has left!"
+				userinfo = botdata.userinfo(members[0].id)
+				if userinfo.outro != "" and userinfo.outro != clip:
+					clip = userinfo.outro
+			else:
+				text += " have left!"
+		return clip, text
+
+	# a list of the names of the given members, capped so that big groups don't get a super long announcement
+	async def get_names_text(self, members):
+		names = []
+		for member in members[:max_announced_names]:
+			names.append(await self.fix_name(member.name))
+		others = len(members) - len(names)
+		if others > 0:
+			names.append(f"{others} other{'s' if others > 1 else ''}")
+		if len(names) == 1:
+			return names[0]
+		return ", ".join(names[:-1]) + " and " + names[-1]
 
 def setup(bot):
 	bot.add_cog(Audio(bot))
@@ -1,29 +1,66 @@
 import discord
 from discord.ext import commands
-from sqlalchemy.sql.expression import func
-from sqlalchemy import and_, or_
 from __main__ import settings
 from cogs.utils.helpers import *
 from cogs.utils.clip import *
 from cogs.utils import drawdota
+from cogs.utils.lookupindex import LookupIndex, SubstringIndex
+from cogs.utils.responseindex import ResponseIndex
+from cogs.utils.memorydb import MemoryDatabase, dotabase_indexes
+from cogs.utils.dotainfo import DotaInfo, dotabase_version
 import random
 import os
 import asyncio
 import string
 import re
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker, scoped_session, joinedload
 from .mangocog import *
 from dotabase import *
 from cogs.audio import AudioPlayerNotFoundError
 
-session = dotabase_session()
+# dotabase is read only, so it can be served from a copy in memory instead of from the disk
+if settings.dotabase_in_memory:
+	memory_db = MemoryDatabase(dotabase_db, "dotabase", dotabase_indexes)
+	print(f"dotabase copied into memory in {memory_db.load_time * 1000:.0f}ms")
+	session = Session(create_engine("sqlite://", creator=memory_db.connect))
+else:
+	session = dotabase_session()
+
+# Queries made while the bot is running are done on these threads so that they don't block the event loop
+# Each thread has its own session, because sqlalchemy sessions aren't thread safe
+query_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dotabase")
+thread_session = scoped_session(sessionmaker(bind=session.get_bind()))
+
+# runs func(session, *args) on one of the dotabase query threads
+# the objects it returns are detached from the thread's session, which is removed after each query, so anything that is used
+# from them has to be loaded by the query (like with joinedload). using anything else raises an error instead of querying on the loop
+async def run_query(func, *args):
+	def run():
+		session = thread_session()
+		try:
+			result = func(session, *args)
+			session.expunge_all()
+			return result
+		finally:
+			thread_session.remove()
+	return await asyncio.get_event_loop().run_in_executor(query_executor, run)
+
+# the number of best matching responses that a text search picks from
+# before this was capped, the random pick was made from every response containing the phrase, so common phrases
+# now only pick from their best matches (see ResponseIndex.search), rather than from all of them
+max_search_results = 20
+
+vpkurl = "http://dotabase.me/dota-vpk"
+dotainfo_snapshot = settings.resource("cache/dotabase_snapshot.json")
 
 
 # A variable that can specify a filter on a query
 class QueryVariable():
-	def __init__(self, name, aliases, query_filter, prefix=";"):
+	def __init__(self, name, aliases, prefix=";"):
 		self.name = name
 		self.aliases = aliases
-		self.query_filter = query_filter
 		self.prefix = prefix
 		self.value = None
 
@@ -33,9 +70,6 @@ class QueryVariable():
 		else:
 			return self.name + " = " + self.value
 
-	def apply_filter(self, query):
-		return self.query_filter(query, self.value)
-
 # extracts variables from the given words, removing them when extracted
 # extracts all words with the prefix, throwing a UserError if finding too many of a given variable or an invalid one
 def extract_var_prefix(words, variables):
@@ -67,6 +101,58 @@ def extract_var(words, variables):
 				return True
 	return False
 
+def clean_ability_input(text):
+	return re.sub(r'[^a-z1-9\s]', r'', str(text).lower())
+
+def simplify_chatwheel(text):
+	text = re.sub(r"[?!',！？.-]", "", text.lower())
+	return re.sub(r"[_，]", " ", text)
+
+# queries dotabase for everything that goes into the DotaInfo snapshot
+def build_dota_info(version):
+	data = OrderedDict()
+	data["version"] = version
+	data["hero_infos"] = {}
+	data["hero_aliases"] = {}
+	data["hero_names"] = []
+	for hero in session.query(Hero):
+		data["hero_infos"][hero.id] = {
+			"name": hero.localized_name,
+			"full_name": hero.full_name,
+			"icon": vpkurl + hero.icon,
+			"attr": hero.attr_primary,
+			"portrait": vpkurl + hero.portrait,
+			"image": vpkurl + hero.image
+		}
+		for alias in hero.aliases.split("|"):
+			data["hero_aliases"][alias] = hero.id
+			data["hero_aliases"][alias.replace(" ", "")] = hero.id
+		data["hero_names"].append([ hero.id, hero.localized_name ])
+
+	data["item_infos"] = {}
+	for item in session.query(Item):
+		data["item_infos"][item.id] = {
+			"name": item.localized_name,
+			"icon": vpkurl + item.icon,
+		}
+
+	data["chat_wheel_infos"] = {}
+	data["chatwheel_sounds"] = []
+	for message in session.query(ChatWheelMessage):
+		data["chat_wheel_infos"][message.id] = {
+			"name": message.name,
+			"message": message.message,
+			"is_sound": message.sound != None,
+			"sound": vpkurl + message.sound if message.sound else None
+		}
+		if message.sound:
+			data["chatwheel_sounds"].append([ message.id, message.name, message.message, message.label, message.sound ])
+
+	data["criteria_aliases"] = [ crit.name for crit in session.query(Criterion).filter(Criterion.matchkey == "Concept") ]
+	data["ability_names"] = [ [ ability.id, ability.localized_name ] for ability in session.query(Ability) ]
+	data["responses"] = [ list(response) for response in session.query(Response.name, Response.text, Response.text_simple, Response.hero_id, Response.criteria) ]
+	return data
+
 
 class Dotabase(MangoCog):
 	"""Dota hero responses and info
@@ -75,100 +161,115 @@ class Dotabase(MangoCog):
 	def __init__(self, bot):
 		MangoCog.__init__(self, bot)
 		self.session = session
+		self.vpkurl = vpkurl
+		self.info = DotaInfo.load(dotainfo_snapshot, dotabase_version(dotabase_db), build_dota_info)
 		self.criteria_aliases = read_json(settings.resource("json/criteria_aliases.json"))
 		self.hero_aliases = {}
 		self.build_aliases()
-		self.vpkurl = "http://dotabase.me/dota-vpk"
-		drawdota.init_dota_info(self.get_hero_infos(), self.get_item_infos())
+		self.build_lookup_indexes()
+		self.build_chatwheel_indexes()
+		self.response_index = ResponseIndex(
+			((r.name, r.text_simple, r.hero_id, r.criteria) for r in self.info.responses),
+			self.criteria_aliases.values())
+		drawdota.init_dota_info(self.info.hero_infos, self.info.item_infos)
+		audio = self.bot.get_cog("Audio")
+		if audio:
+			self.add_to_clip_resolver(audio.clip_resolver)
 
 	def build_aliases(self):
-		for hero in session.query(Hero):
-			aliases = hero.aliases.split("|")
-			for alias in aliases:
-				self.hero_aliases[alias] = hero.id
-				self.hero_aliases[alias.replace(" ", "")] = hero.id
-
-		for crit in session.query(Criterion).filter(Criterion.matchkey == "Concept"):
-			self.criteria_aliases[crit.name.lower()] = crit.name
-
-	def lookup_hero(self, hero):
+		self.hero_aliases.update(self.info.hero_aliases)
+
+		for crit in self.info.criteria_aliases:
+			self.criteria_aliases[crit.lower()] = crit
+
+	# builds the indexes used by lookup_hero_id and lookup_ability, so they dont have to loop over everything
+	def build_lookup_indexes(self):
+		self.hero_ids = set()
+		self.hero_name_index = LookupIndex()
+		for hero_id, name in self.info.hero_names:
+			self.hero_ids.add(hero_id)
+			self.hero_name_index.add(name.lower(), hero_id)
+
+		self.hero_alias_index = LookupIndex(substrings=True)
+		for alias in self.hero_aliases:
+			self.hero_alias_index.add(alias, self.hero_aliases[alias])
+
+		self.ability_index = LookupIndex()
+		for ability_id, name in self.info.ability_names:
+			self.ability_index.add(clean_ability_input(name), ability_id)
+
+	# builds the indexes used by get_chatwheel_sound, from the simplified name, message, and label of each chat wheel sound
+	def build_chatwheel_indexes(self):
+		self.chatwheel_sounds = []
+		self.chatwheel_exact = {}
+		self.chatwheel_nospace = {}
+		substrings = []
+		for message in self.info.chatwheel_sounds:
+			self.chatwheel_sounds.append(message)
+			for string in map(simplify_chatwheel, [ message.name, message.message, message.label ]):
+				if string == "":
+					continue
+				self.chatwheel_exact.setdefault(string, message)
+				self.chatwheel_nospace.setdefault(string.replace(" ", ""), message)
+				substrings.append((string, message))
+		self.chatwheel_substrings = SubstringIndex(substrings)
+
+	# adds the chat wheel sounds and exact response texts to the resolver used by smarttts
+	def add_to_clip_resolver(self, resolver):
+		for message in self.chatwheel_sounds:
+			for text in [ message.name, message.message, message.label ]:
+				if text:
+					resolver.add(text, f"url:{self.vpkurl}{message.sound}", 1)
+		for response in self.info.responses:
+			resolver.add(response.name, f"dota:{response.name}", 2)
+			resolver.add(response.text, f"dota:{response.name}", 2)
+
+	async def lookup_hero(self, hero):
 		if not hero:
 			return None
 		hero_id = self.lookup_hero_id(hero)
 		if hero_id:
-			return session.query(Hero).filter(Hero.id == hero_id).first()
+			return await run_query(lambda s: s.query(Hero).filter(Hero.id == hero_id).first())
 		else:
 			return None
 
 	def lookup_hero_id(self, text):
 		if isinstance(text, int) or text.isdigit():
-			query = session.query(Hero).filter(Hero.id == int(text))
-			return int(text) if query.count() > 0 else None
+			return int(text) if int(text) in self.hero_ids else None
 		text = re.sub(r'[^a-z^\s]', r'', text.lower())
 		if text == "":
 			return None
 		if text in self.hero_aliases:
 			return self.hero_aliases[text]
-		for hero in session.query(Hero):
-			if hero.localized_name.lower().startswith(text):
-				return hero.id
-		for hero in self.hero_aliases:
-			if hero.startswith(text):
-				return self.hero_aliases[hero]
-		for hero in self.hero_aliases:
-			if text in hero:
-				return self.hero_aliases[hero]
-		return None
-
-	def lookup_ability(self, text):
+		hero_id = self.hero_name_index.prefix(text)
+		if hero_id is None:
+			hero_id = self.hero_alias_index.prefix(text)
+		if hero_id is None:
+			hero_id = self.hero_alias_index.substring(text)
+		return hero_id
+
+	async def lookup_ability(self, text):
 		if isinstance(text, int) or text.isdigit():
-			return session.query(Ability).filter(Ability.id == int(text)).first()
-		def clean_input(t):
-			return re.sub(r'[^a-z1-9\s]', r'', str(t).lower())
-		text = clean_input(text)
+			return await run_query(lambda s: s.query(Ability).filter(Ability.id == int(text)).first())
+		text = clean_ability_input(text)
 		if text == "":
 			return None
-		for ability in session.query(Ability):
-			if clean_input(ability.localized_name) == text:
-				return ability
-		for ability in session.query(Ability):
-			if clean_input(ability.localized_name).startswith(text):
-				return ability
-		return None
+		ability_id = self.ability_index.exact(text)
+		if ability_id is None:
+			ability_id = self.ability_index.prefix(text)
+		if ability_id is None:
+			return None
+		return await run_query(lambda s: s.query(Ability).filter(Ability.id == ability_id).first())
 
 
 	def get_hero_infos(self):
-		result = {}
-		for hero in session.query(Hero):
-			result[hero.id] = {
-				"name": hero.localized_name,
-				"full_name": hero.full_name,
-				"icon": self.vpkurl + hero.icon,
-				"attr": hero.attr_primary,
-				"portrait": self.vpkurl + hero.portrait,
-				"image": self.vpkurl + hero.image
-			}
-		return result
+		return self.info.hero_infos
 
 	def get_item_infos(self):
-		result = {}
-		for item in session.query(Item):
-			result[item.id] = {
-				"name": item.localized_name,
-				"icon": self.vpkurl + item.icon,
-			}
-		return result
+		return self.info.item_infos
 
 	def get_chat_wheel_infos(self):
-		result = {}
-		for message in session.query(ChatWheelMessage):
-			result[message.id] = {
-				"name": message.name,
-				"message": message.message,
-				"is_sound": message.sound != None,
-				"sound": self.vpkurl + message.sound if message.sound else None
-			}
-		return result
+		return self.info.chat_wheel_infos
 
 	def get_chatwheel_sound_clip(self, text):
 		message = self.get_chatwheel_sound(text)
@@ -177,36 +278,28 @@ class Dotabase(MangoCog):
 		else:
 			return None
 
+	# finds the chat wheel sound with the given text
+	# loose_fit also allows matches that ignore spaces, or where the text is just part of the sound's text
 	def get_chatwheel_sound(self, text, loose_fit=False):
-		def simplify(t):
-			t = re.sub(r"[?!',！？.-]", "", t.lower())
-			return re.sub(r"[_，]", " ", t)
-		text = simplify(text)
+		text = simplify_chatwheel(text)
 		if text == "":
 			return None
-		for message in session.query(ChatWheelMessage):
-			if message.sound:
-				strings = list(map(simplify, [ message.name, message.message, message.label ]))
-				if text in strings:
-					return message
-				if loose_fit:
-					for string in strings:
-						if text.replace(" ", "") == string.replace(" ", ""):
-							return message
-					for string in strings:
-						if text in string:
-							return message
-		return None
+		message = self.chatwheel_exact.get(text)
+		if message is None and loose_fit:
+			message = self.chatwheel_nospace.get(text.replace(" ", ""))
+			if message is None:
+				message = self.chatwheel_substrings.find(text)
+		return message
 
 	async def play_response(self, response, ctx):
 		await self.play_clip("dota:" + response.name, ctx)
 
-	def get_response(self, responsename):
-		return session.query(Response).filter(Response.name == responsename).first()
+	async def get_response(self, responsename):
+		return await run_query(lambda s: s.query(Response).options(joinedload(Response.hero)).filter(Response.name == responsename).first())
 
-	# Plays a random response from a query
+	# Plays a random response from a query, which is a list of rows from the response index
 	async def play_response_query(self, query, ctx):
-		await self.play_response(query.order_by(func.random()).first(), ctx)
+		await self.play_clip("dota:" + self.response_index.names[random.choice(query)], ctx)
 
 	@commands.command(aliases=["dotar"])
 	async def dota(self, ctx, *, keyphrase : str=None):
@@ -242,8 +335,8 @@ class Dotabase(MangoCog):
 
 	async def dota_keyphrase_query(self, keyphrase):
 		variables = [
-			QueryVariable("hero", self.hero_aliases, lambda query, value: query.filter(Response.hero_id == value)),
-			QueryVariable("criteria", self.criteria_aliases, lambda query, value: query.filter(or_(Response.criteria.like(value + "%"), Response.criteria.like("%|" + value + "%")))),
+			QueryVariable("hero", self.hero_aliases),
+			QueryVariable("criteria", self.criteria_aliases),
 		]
 
 		if keyphrase is None:
@@ -262,35 +355,41 @@ class Dotabase(MangoCog):
 		return query
 
 
+	# returns a list of the rows in the response index that match the words and variables, or None if there aren't any
 	async def smart_dota_query(self, words, variables, exact=False):
-		basequery = session.query(Response)
-		for var in variables:
-			if var.value is not None:
-				basequery = var.apply_filter(basequery)
-
+		filters = { var.name: var.value for var in variables }
 		keyphrase = " ".join(words)
 
 		if keyphrase == None or keyphrase == "" or keyphrase == " ":
-			if basequery.count() > 0:
-				return basequery
+			if self.response_index.count(filters.get("hero"), filters.get("criteria")) > 0:
+				return self.response_index.get_rows(filters.get("hero"), filters.get("criteria"))
 			else:
 				return None
 
+		# Filters rows from the response index, optionally keeping only the first (most relevant) ones
+		def rows_query(rows, limit=None):
+			rows = self.response_index.filter(rows, filters.get("hero"), filters.get("criteria"))
+			if len(rows) == 0:
+				return None
+			if limit is not None:
+				rows = rows[:limit]
+			return rows
+
 		# Because some of wisp's responses are not named correctly
 		if '_' in keyphrase:
-			query = basequery.filter(Response.name == keyphrase)
-			if query.count() > 0:
+			query = rows_query(self.response_index.find_name(keyphrase))
+			if query:
 				return query
 
 		simple_input = " " + re.sub(r'[^a-z0-9\s]', r'', keyphrase.lower()) + " "
 
-		query = basequery.filter(Response.text_simple == simple_input)
-		if query.count() > 0:
+		query = rows_query(self.response_index.find_text(simple_input))
+		if query:
 			return query
 
 		if not exact:
-			query = basequery.filter(Response.text_simple.like("%" + simple_input + "%"))
-			if query.count() > 0:
+			query = rows_query(self.response_index.search(simple_input), max_search_results)
+			if query:
 				return query
 
 		return None
@@ -315,23 +414,24 @@ class Dotabase(MangoCog):
 			"gyro_move_26"
 		]
 		dota_response = random.choice(dota_hellos)
-		response = session.query(Response).filter(Response.name == dota_response).first()
-		print("hello: " + response.name)
-		await self.play_response(response, ctx)
+		print("hello: " + dota_response)
+		await self.play_clip("dota:" + dota_response, ctx)
 
 	# Plays the correct command for the given keyphrase and hero, if a valid one is given
 	async def hero_keyphrase_command(self, keyphrase, hero, ctx):
 		query = await self.dota_keyphrase_query(keyphrase)
+		if query is None:
+			raise UserError("No responses found! 😱")
 		if hero is None:
 			await self.play_response_query(query, ctx)
 			return
 
-		hero = self.lookup_hero(hero)
+		hero = await self.lookup_hero(hero)
 		if hero is None:
 			raise UserError("Don't know what hero yer talkin about")
 		else:
-			query = query.filter(Response.hero_id == hero.id)
-			if query.count() > 0:
+			query = self.response_index.filter(query, hero_id=hero.id)
+			if len(query) > 0:
 				await self.play_response_query(query, ctx)
 			else:
 				raise UserError(f"No responses found for {hero.localized_name}! 😱")
@@ -364,12 +464,14 @@ class Dotabase(MangoCog):
 	async def inthebag(self, ctx, *, hero=None):
 		"""Proclaims that 'IT' (whatever it is) is in the bag"""
 		query = await self.dota_keyphrase_query(";inthebag")
+		def not_plain(rows):
+			return [ row for row in rows if self.response_index.texts[row] != " its in the bag " ]
 		if hero is None:
-				await self.play_response_query(query.filter(Response.text_simple != " its in the bag "), ctx)
+				await self.play_response_query(not_plain(query), ctx)
 		elif hero in self.hero_aliases:
-			query = query.filter(Response.hero_id == self.hero_aliases[hero])
-			newquery = query.filter(Response.text_simple != " its in the bag ")
-			if newquery.count() > 0:
+			query = self.response_index.filter(query, hero_id=self.hero_aliases[hero])
+			newquery = not_plain(query)
+			if len(newquery) > 0:
 				await self.play_response_query(newquery, ctx)
 			else:
 				await self.play_response_query(query, ctx)
@@ -390,9 +492,8 @@ class Dotabase(MangoCog):
 		`{cmdpfx}chatwheel Это ГГ`"""
 		if text.lower() in [ "help", "list" ]:
 			sounds = []
-			for message in session.query(ChatWheelMessage):
-				if message.sound:
-					sounds.append(f"{self.get_emoji('chat_wheel_sound')} {message.message}")
+			for message in self.chatwheel_sounds:
+				sounds.append(f"{self.get_emoji('chat_wheel_sound')} {message.message}")
 			embed = discord.Embed(description="\n".join(sounds))
 			embed.set_author(name="Chat Wheel Sounds")
 			await ctx.author.send(embed=embed)
@@ -414,7 +515,7 @@ class Dotabase(MangoCog):
 		`{cmdpfx}hero sf`
 		`{cmdpfx}hero inker`
 		`{cmdpfx}hero furi`"""
-		hero = self.lookup_hero(hero)
+		hero = await self.lookup_hero(hero)
 		if not hero:
 			raise UserError("That doesn't look like a hero")
 
@@ -474,8 +575,8 @@ class Dotabase(MangoCog):
 
 		await ctx.send(embed=embed)
 
-		query = session.query(Response).filter(Response.hero_id == hero.id).filter(or_(Response.criteria.like("Spawn %"), Response.criteria.like("Spawn%")))
-		if query.count() > 0:
+		query = [ row for row in self.response_index.get_rows(hero.id) if self.response_index.criteria[row].startswith("spawn") ]
+		if len(query) > 0:
 			try:
 				await self.play_response_query(query, ctx)
 			except AudioPlayerNotFoundError:
@@ -490,7 +591,7 @@ class Dotabase(MangoCog):
 		`{cmdpfx}ability laser`
 		`{cmdpfx}ability sprout`"""
 
-		ability = self.lookup_ability(ability)
+		ability = await self.lookup_ability(ability)
 
 		if ability is None:
 			raise UserError("I couldn't find an ability by that name")
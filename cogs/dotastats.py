@@ -4,6 +4,10 @@ from __main__ import settings, botdata, thinker, httpgetter
 from cogs.utils import checks
 from cogs.utils import helpers
 from cogs.utils import drawdota
+from cogs.utils.matchstore import MatchStore, history_fields, roaming_lane
+from cogs.utils.matchmodel import Match
+from cogs.utils.parsetracker import ParseTracker
+from cogs.utils.matchwatcher import MatchWatcher
 import asyncio
 import async_timeout
 import string
@@ -14,8 +18,9 @@ import os
 import urllib
 import functools
 import time
-import statistics
 import random
+import math
+from io import BytesIO
 from types import *
 from .mangocog import *
 
@@ -33,12 +38,23 @@ class MatchNotParsedError(UserError):
 		self.action = action if action else "do that"
 		super().__init__(f"This match must be parsed before I can {self.action}.\nTry `?parse {match_id}` to request a parse.")
 
+class ParseRequestError(UserError):
+	def __init__(self, match_id):
+		self.match_id = match_id
+		super().__init__(f"❌ There was an error requesting the parse for match {match_id}")
+
 opendota_html_errors = {
 	404: "Dats not a valid query. Take a look at the OpenDota API Documentation: https://docs.opendota.com",
 	521: "Looks like the OpenDota API is down or somethin, so ya gotta wait a sec",
 	"default": "OpenDota said we did things wrong 😢. status code: {}"
 }
 
+# the steam ids of all of the users who have linked their steam accounts
+def registered_steam32s():
+	return set(userinfo.steam32 for userinfo in botdata.userinfo_list() if userinfo.steam32 is not None)
+
+matchstore = MatchStore(settings.resource("matchstore.db"), registered_steam32s())
+
 async def opendota_query(querystring, cache=False):
 	return await httpgetter.get(f"https://api.opendota.com/api{querystring}", cache=cache, errors=opendota_html_errors)
 
@@ -48,10 +64,133 @@ async def get_match(match_id):
 	cached_data = httpgetter.cache.get(url, "json")
 	if cached_data:
 		if cached_data["version"]:
-			return cached_data
+			if not await matchstore.run(matchstore.has_match, match_id, True):
+				await matchstore.run(matchstore.add_match, cached_data, registered_steam32s())
+			return Match(cached_data)
 		else:
 			await httpgetter.cache.remove(url)
-	return await opendota_query(f"/matches/{match_id}", cache=True)
+	match = await opendota_query(f"/matches/{match_id}", cache=True)
+	await matchstore.run(matchstore.add_match, match, registered_steam32s())
+	return Match(match)
+
+# asks opendota to parse a match, returning the id of the parse job
+async def request_parse(match_id):
+	data = await httpgetter.post(f"https://api.opendota.com/api/request/{match_id}", errors=opendota_html_errors)
+	if data.get("status") == "failed" or data.get("err") is not None:
+		raise ParseRequestError(match_id)
+	return data["job"]["jobId"]
+
+# returns true if the parse job has finished
+async def check_parse_job(job_id):
+	return (await opendota_query(f"/request/{job_id}")) is None
+
+# removes the unparsed version of the match from the cache, so the next get_match gets the parsed one
+async def on_match_parsed(match_id):
+	url = f"https://api.opendota.com/api/matches/{match_id}"
+	if httpgetter.cache.get_filename(url):
+		await httpgetter.cache.remove(url)
+
+# the id of the player's most recent match
+async def get_latest_match_id(steam32):
+	return (await opendota_query(f"/players/{steam32}/matches?limit=1"))[0]["match_id"]
+
+# makes sure the match is in the match store, only fetching it if it isn't there yet
+# returns whether the match is parsed
+async def store_match(match_id):
+	if await matchstore.run(matchstore.has_match, match_id, True):
+		return True
+	return (await get_match(match_id)).is_parsed
+
+# a player's history isn't synced with opendota again if it was synced less than this many seconds ago
+history_sync_interval = 60
+# matches this many seconds older than the latest one we have are fetched again when syncing, so that matches that got parsed since then are updated
+history_sync_overlap = 86400 * 2
+
+# syncs the player's match history in the match store with opendota, unless it was synced less than max_age seconds ago
+# the first sync gets all of their matches, and after that only the matches since the last one we have are fetched
+async def sync_history(steam32, max_age=history_sync_interval):
+	sync = await matchstore.run(matchstore.get_history_sync, steam32)
+	now = int(time.time())
+	if sync is not None and now - sync[0] < max_age:
+		return
+	query = f"/players/{steam32}/matches?" + "&".join(f"project={field}" for field in history_fields)
+	if sync is not None and sync[1] is not None:
+		days = math.ceil((now - sync[1] + history_sync_overlap) / 86400)
+		query += f"&date={days}"
+	matches = await opendota_query(query)
+	await matchstore.run(matchstore.add_history, steam32, matches, now)
+
+# how often the players who have ?watchmatches enabled are checked for new matches, in seconds
+match_watch_interval = 60 * 5
+# how long after a watched match is found that it keeps getting fetched and drawn again while it isn't parsed, in seconds
+match_watch_parse_wait = 60 * 60
+
+# the most matches that are fetched from opendota at once. kept low so we stay under opendota's rate limit
+match_fetch_concurrency = 4
+
+# syncs the histories of all of the given players, up to match_fetch_concurrency of them at a time
+# a player whose history can't be synced is skipped, and whatever we already had of their history is used
+async def sync_histories(steam32s, max_age=history_sync_interval):
+	semaphore = asyncio.Semaphore(match_fetch_concurrency)
+	async def sync(steam32):
+		async with semaphore:
+			await sync_history(steam32, max_age)
+	results = await asyncio.gather(*[ sync(steam32) for steam32 in steam32s ], return_exceptions=True)
+	for steam32, result in zip(steam32s, results):
+		if isinstance(result, Exception):
+			print(f"syncing history of {steam32} failed: {result}")
+
+# how many seconds back the leaderboard looks
+leaderboard_window = 86400 * 30
+# players need at least this many matches in the window to be on the leaderboard
+leaderboard_min_games = 5
+# a guild's leaderboard is reused for this many seconds, and after that only the histories older than this are synced again
+leaderboard_refresh_interval = 60 * 10
+
+# metric -> (title, function that gets the value from a player's stats, format of the value)
+leaderboard_metrics = {
+	"winrate": ("Winrate", lambda p: 100 * p["wins"] / p["games"], "{:.0f}%"),
+	"games": ("Games Played", lambda p: p["games"], "{}"),
+	"kda": ("KDA", lambda p: None if p["kills"] is None else (p["kills"] + (p["assists"] or 0)) / max(p["deaths"] or 0, 1), "{:.2f}"),
+	"gpm": ("GPM", lambda p: p["gold_per_min"], "{:.0f}"),
+	"xpm": ("XPM", lambda p: p["xp_per_min"], "{:.0f}"),
+	"lasthits": ("Last Hits", lambda p: p["last_hits"], "{:.0f}")
+}
+
+# gets the first count parsed matches out of the given match ids into the match store, fetching up to max_concurrent of them at a time
+# returns their ids in the same order as the given ids, and cancels any fetches still going once it has them
+async def store_parsed_matches(match_ids, count, max_concurrent=match_fetch_concurrency):
+	match_ids = iter(enumerate(match_ids))
+	tasks = {} # task -> index of the match id
+	results = {} # index of the match id -> match id
+
+	# whether we have count matches, and no match before them is still being fetched
+	def finished():
+		if len(results) < count:
+			return False
+		cutoff = sorted(results)[count - 1]
+		return all(i > cutoff for i, match_id in tasks.values())
+
+	def start_next():
+		for i, match_id in match_ids:
+			tasks[asyncio.ensure_future(store_match(match_id))] = i, match_id
+			return
+
+	try:
+		for i in range(max_concurrent):
+			start_next()
+		while tasks and not finished():
+			done, pending = await asyncio.wait(tasks.keys(), return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				i, match_id = tasks.pop(task)
+				if task.result():
+					results[i] = match_id
+				if not finished():
+					start_next()
+	finally:
+		for task in tasks:
+			task.cancel()
+	return [ results[i] for i in sorted(results)[:count] ]
 
 def s_if_plural(text, n):
 	return text + "s" if n > 1 else text
@@ -104,9 +243,6 @@ def format_duration_simple(duration):
 		return f"{int((duration / 60) % 60)}:{duration % 60:02}"
 
 
-def is_parsed(match_json):
-	return match_json.get("version", None) is not None
-
 # gets the steam32 id from the user or steamid and checks that it is valid before returning
 # If ref is specified, returns either a link or a discord user mention, depending on the input
 async def get_check_steamid(player, ctx, mention=False):
@@ -168,6 +304,15 @@ def format_teamfight(teamfight):
 
 
 
+# the columns that each command gets from the match store
+playerstats_columns = [ "win", "kills", "deaths", "assists", "duration", "party_size", "lobby_type", "gold_per_min", "last_hits", "neutral_kills",
+	"obs_placed", "sen_placed", "hero_id", "randomed", "lane_role", "is_roaming" ]
+player_match_stats_columns = [ "personaname", "hero_id", "win", "kills", "deaths", "assists", "hero_damage", "hero_healing", "tower_damage",
+	"total_gold", "last_hits", "denies", "level" ]
+match_image_columns = [ "player_slot", "account_id", "isRadiant", "hero_id", "personaname", "kills", "deaths", "assists", "gold_per_min", "actions_per_min",
+	"lane", "lane_role", "is_roaming", "pings", "item_0", "item_1", "item_2", "item_3", "item_4", "item_5" ]
+
+
 class DotaStats(MangoCog):
 	"""Dota player and match stats
 
@@ -179,34 +324,54 @@ class DotaStats(MangoCog):
 		dotabase = self.bot.get_cog("Dotabase")
 		if not dotabase:
 			raise ImportError("The Dotabase cog must be added before the DotaStats cog")
-		self.hero_info = dotabase.get_hero_infos()
+		self.hero_info = dotabase.info.hero_infos
 		self.lookup_hero = dotabase.lookup_hero
-		self.chat_wheel_info = dotabase.get_chat_wheel_infos()
+		self.lookup_hero_id = dotabase.lookup_hero_id
+		self.chat_wheel_info = dotabase.info.chat_wheel_infos
+		self.parse_tracker = ParseTracker(self.bot.loop, request_parse, check_parse_job, on_match_parsed)
+		self.leaderboards = {} # guild id -> (time it was made, steam ids of the players in it, stats of each player)
+		self.match_watcher = MatchWatcher(self.get_watched_players, get_latest_match_id, self.create_player_match_stats,
+			lambda prepared: prepared[2], match_watch_interval, match_watch_parse_wait)
+		self.watch_task = self.bot.loop.create_task(self.watch_matches())
+
+	def __unload(self):
+		self.watch_task.cancel()
+
+	async def watch_matches(self):
+		await self.bot.wait_until_ready()
+		await self.match_watcher.run()
+
+	# the steam ids of the users who have ?watchmatches enabled and are online in one of our guilds
+	def get_watched_players(self):
+		online = set(member.id for member in self.bot.get_all_members() if member.status != discord.Status.offline)
+		watched = []
+		for userinfo in botdata.userinfo_list():
+			if userinfo.watchmatches and userinfo.steam32 is not None and userinfo.discord in online and userinfo.steam32 not in watched:
+				watched.append(userinfo.steam32)
+		return watched
 
 	def get_pretty_hero(self, player):
-		dotabase = self.bot.get_cog("Dotabase")
-		return "**{}**".format(self.hero_info[player['hero_id']]['name'])
+		return "**{}**".format(self.hero_info[player.hero_id]['name'])
 
 	async def get_teamfights(self, game, is_radiant):
 		teamfights = []
-		for teamfight in game['teamfights']:
+		for teamfight in game.teamfights:
 			net_gain = 0
 			our_dead = []
 			their_dead = []
-			num_players = min([ len(teamfight['players']), len(game['players']) ])
-			for i in range(0, num_players):
-				deadtext = self.get_pretty_hero(game['players'][i])
-				if teamfight['players'][i]['deaths'] == 0:
+			for player, fight_player in zip(game.players, teamfight.players):
+				deadtext = self.get_pretty_hero(player)
+				if fight_player.deaths == 0:
 					deadtext = None
-				elif teamfight['players'][i]['deaths'] > 1:
-					deadtext += "(x{})".format(teamfight['players'][i]['deaths'])
+				elif fight_player.deaths > 1:
+					deadtext += "(x{})".format(fight_player.deaths)
 
-				if (game['players'][i]['isRadiant'] == is_radiant): # on our team
-					net_gain += teamfight['players'][i]['gold_delta']
+				if (player.is_radiant == is_radiant): # on our team
+					net_gain += fight_player.gold_delta
 					if deadtext:
 						our_dead.append(deadtext)
 				else:
-					net_gain -= teamfight['players'][i]['gold_delta']
+					net_gain -= fight_player.gold_delta
 					if deadtext:
 						their_dead.append(deadtext)
 			teamfight_dict = {
@@ -214,33 +379,32 @@ class DotaStats(MangoCog):
 					"our_dead": pretty_list(our_dead, None),
 					"their_dead": pretty_list(their_dead, None),
 					"net_change": abs(net_gain),
-					"deaths": teamfight['deaths'],
-					"time": teamfight['start'],
-					"time_end": teamfight['end']
+					"deaths": teamfight.deaths,
+					"time": teamfight.start,
+					"time_end": teamfight.end
 				}
 			teamfight_dict['formatted'] = format_teamfight(teamfight_dict)
 			teamfights.append(teamfight_dict)
 		return teamfights
 
 	async def get_firstblood_story(self, game, is_radiant):
-		fb_objective = next((obj for obj in game['objectives'] if obj['type'] == "CHAT_MESSAGE_FIRSTBLOOD"), None)
+		fb_objective = next((obj for obj in game.objectives if obj.type == "CHAT_MESSAGE_FIRSTBLOOD"), None)
 		if fb_objective is None:
 			return "" # No first blood this game, or it wasnt reported in objectives log
 		fb_log = None
-		fb_killer = next(p for p in game['players'] if p['player_slot'] == fb_objective['player_slot'])
-		fb_log = next((kill for kill in fb_killer['kills_log'] if kill['time'] == fb_objective['time']), None)
+		fb_killer = game.get_player_by_slot(fb_objective.player_slot)
+		fb_log = next((kill for kill in fb_killer.kills_log if kill.time == fb_objective.time), None)
 		if fb_log is None:
 			return "" # Can't find the kill log of when first blood happened
-		dotabase = self.bot.get_cog("Dotabase")
-		fb_victim_id = next(h for h in self.hero_info if self.hero_info[h]['full_name'] == fb_log['key'])
-		fb_victim = next(p for p in game['players'] if p['hero_id'] == fb_victim_id)
+		fb_victim_id = next(h for h in self.hero_info if self.hero_info[h]['full_name'] == fb_log.key)
+		fb_victim = game.get_player_by_hero(fb_victim_id)
 
 		return "First blood was drawn when {} {} killed {} {} at {}\n\n".format(
-			"our" if (fb_killer['isRadiant'] == is_radiant) else "their",
+			"our" if (fb_killer.is_radiant == is_radiant) else "their",
 			self.get_pretty_hero(fb_killer),
-			"our" if (fb_victim['isRadiant'] == is_radiant) else "their",
+			"our" if (fb_victim.is_radiant == is_radiant) else "their",
 			self.get_pretty_hero(fb_victim),
-			get_pretty_duration(fb_objective['time']))
+			get_pretty_duration(fb_objective.time))
 
 
 	async def get_timeline_story(self, game, is_radiant):
@@ -275,14 +439,14 @@ class DotaStats(MangoCog):
 		our_heroes = []
 		their_heroes = []
 		for player in players:
-			if player['lane'] == laneid and not player.get('is_roaming', False):
-				if (player['isRadiant'] == is_radiant): #on our team
-					if player['lane_efficiency'] > our_eff:
-						our_eff = player['lane_efficiency']
+			if player.lane == laneid and not player.is_roaming:
+				if (player.is_radiant == is_radiant): #on our team
+					if player.lane_efficiency > our_eff:
+						our_eff = player.lane_efficiency
 					our_heroes.append(self.get_pretty_hero(player))
 				else: #on their team
-					if player['lane_efficiency'] > their_eff:
-						their_eff = player['lane_efficiency']
+					if player.lane_efficiency > their_eff:
+						their_eff = player.lane_efficiency
 					their_heroes.append(self.get_pretty_hero(player))
 		return {
 			"us": pretty_list(our_heroes, "An empty lane"),
@@ -295,12 +459,12 @@ class DotaStats(MangoCog):
 		story = ""
 		lanes = {1: "bottom", 2: "middle", 3: "top"}
 		for laneid in lanes:
-			story += "• {0[us]} {0[won_lost]} {1} lane vs {0[them]}\n".format(await self.get_lane_story(game['players'], laneid, is_radiant), lanes[laneid])
+			story += "• {0[us]} {0[won_lost]} {1} lane vs {0[them]}\n".format(await self.get_lane_story(game.players, laneid, is_radiant), lanes[laneid])
 		return story
 
 	async def tell_match_story(self, game, is_radiant, ctx, perspective=None):
-		if not is_parsed(game):
-			raise MatchNotParsedError(game["match_id"], "create a story")
+		if not game.is_parsed:
+			raise MatchNotParsedError(game.match_id, "create a story")
 
 		if not perspective:
 			perspective = "The Radiant" if is_radiant else "The Dire"
@@ -309,7 +473,7 @@ class DotaStats(MangoCog):
 			end_perspective = f"{perspective} and their friends"
 
 		story = (f"*Told from the perspective of {perspective}*\n"
-				f"To see a more extensive story, try the [story tab](https://www.opendota.com/matches/{game['match_id']}/story) on opendota\n\n")
+				f"To see a more extensive story, try the [story tab](https://www.opendota.com/matches/{game.match_id}/story) on opendota\n\n")
 
 		story += await self.get_firstblood_story(game, is_radiant)
 
@@ -319,20 +483,22 @@ class DotaStats(MangoCog):
 		if teamfights != "":
 			story += teamfights
 
-		game_ending_state = "won" if (is_radiant == game['radiant_win']) else "lost"
-		story += f"\n{end_perspective} {game_ending_state} the game at { get_pretty_duration(game['duration']) }"
+		game_ending_state = "won" if (is_radiant == game.radiant_win) else "lost"
+		story += f"\n{end_perspective} {game_ending_state} the game at { get_pretty_duration(game.duration) }"
 
 		embed = discord.Embed(description=story, color=self.embed_color)
-		embed.set_author(name="Story of Match {}".format(game["match_id"]), url="https://www.opendota.com/matches/{}".format(game["match_id"]))
-		embed.set_footer(text="For more information, try ?match {}".format(game["match_id"]))
+		embed.set_author(name="Story of Match {}".format(game.match_id), url="https://www.opendota.com/matches/{}".format(game.match_id))
+		embed.set_footer(text="For more information, try ?match {}".format(game.match_id))
 		await ctx.send(embed=embed)
 
-	# prints the stats for the given player's latest game
-	async def player_match_stats(self, steamid, match_id, ctx):
-		game = await get_match(match_id)
+	# makes the embed and match image for the given player's stats in the given match
+	# returns the embed, the bytes of the image (so that they can be kept and sent more than once), and whether the match was parsed
+	async def create_player_match_stats(self, steamid, match_id):
+		parsed = await store_match(match_id)
+		game = Match(await matchstore.run(matchstore.get_match, match_id, match_image_columns))
 
 		# Finds the player in the game which has our matching steam32 id
-		player = next(p for p in game['players'] if p['account_id'] == steamid)
+		player = await matchstore.run(matchstore.get_player, steamid, match_id, player_match_stats_columns)
 		if player is None:
 			raise ValueError("wtf they're not in their own game")
 
@@ -345,9 +511,9 @@ class DotaStats(MangoCog):
 					"More info at [DotaBuff](https://www.dotabuff.com/matches/{3}), "
 					"[OpenDota](https://www.opendota.com/matches/{3}), or "
 					"[STRATZ](https://www.stratz.com/match/{3})"
-					.format(winstatus, hero_name, get_pretty_duration(game['duration'], postfix=False), match_id))
+					.format(winstatus, hero_name, get_pretty_duration(game.duration, postfix=False), match_id))
 
-		embed = discord.Embed(description=description, color=self.embed_color, timestamp=datetime.datetime.utcfromtimestamp(game['start_time']))
+		embed = discord.Embed(description=description, color=self.embed_color, timestamp=datetime.datetime.utcfromtimestamp(game.start_time))
 
 		embed.set_author(name=player['personaname'], icon_url=self.hero_info[player['hero_id']]['icon'], url="https://www.opendota.com/players/{}".format(steamid))
 
@@ -363,11 +529,11 @@ class DotaStats(MangoCog):
 			"Denies: {denies}\n"
 			"Level: {level}\n".format(**player)))
 
-		match_image = discord.File(await drawdota.create_match_image(game), "match.png")
-		embed.set_image(url=f"attachment://{match_image.filename}")
+		match_image = (await drawdota.create_match_image(game)).getvalue()
+		embed.set_image(url="attachment://match.png")
 		embed.set_footer(text="Started")
 
-		await ctx.send(embed=embed, file=match_image)
+		return embed, match_image, parsed
 
 	@commands.command(aliases=["register"])
 	async def setsteam(self, ctx, steam_id : int, user: discord.User=None):
@@ -407,8 +573,40 @@ class DotaStats(MangoCog):
 		await ctx.channel.trigger_typing()
 
 		steamid = await get_check_steamid(player, ctx)
-		match_id = (await opendota_query(f"/players/{steamid}/matches?limit=1"))[0]["match_id"]
-		await self.player_match_stats(steamid, match_id, ctx)
+		# the latest match is always checked, so a match that finished since the watcher last looked isn't missed
+		match_id = await get_latest_match_id(steamid)
+		# unparsed matches aren't reused, so they're fetched again in case they've been parsed since
+		prepared = self.match_watcher.get(steamid, match_id)
+		if prepared is None:
+			prepared = await self.create_player_match_stats(steamid, match_id)
+			self.match_watcher.put(steamid, match_id, prepared)
+
+		embed, match_image, parsed = prepared
+		await ctx.send(embed=embed, file=discord.File(BytesIO(match_image), "match.png"))
+
+	@commands.command()
+	async def watchmatches(self, ctx, value : str=None):
+		"""Has mangobyte get your new matches ready for ?lastmatch
+
+		While this is enabled and you're online in a server with mangobyte, mangobyte will check for your new matches every few minutes, and draw the ?lastmatch for them before you ask, so it shows up right away.
+
+		**Example:**
+		`{cmdpfx}watchmatches enable`
+		"""
+		userinfo = botdata.userinfo(ctx.message.author.id)
+		if value is None:
+			await ctx.send(f"Match watching is {'enabled' if userinfo.watchmatches else 'disabled'} for you")
+			return
+		if value.lower() in [ "enable", "enabled", "true", "yes" ]:
+			if userinfo.steam32 is None:
+				raise SteamNotLinkedError()
+			userinfo.watchmatches = True
+			await ctx.send("✅ I'll watch for your new matches")
+		elif value.lower() in [ "disable", "disabled", "false", "no" ]:
+			userinfo.watchmatches = False
+			await ctx.send("✅ I'll stop watching for your new matches")
+		else:
+			raise UserError("Invalid input. Give me something like `enable` or `disable`")
 
 	@commands.command(aliases=["matchdetails"])
 	async def match(self, ctx, match_id : int):
@@ -425,10 +623,10 @@ class DotaStats(MangoCog):
 					"More info at [DotaBuff](https://www.dotabuff.com/matches/{1}), "
 					"[OpenDota](https://www.opendota.com/matches/{1}), or "
 					"[STRATZ](https://www.stratz.com/match/{1})"
-					.format(get_pretty_duration(game['duration'], postfix=False), match_id))
+					.format(get_pretty_duration(game.duration, postfix=False), match_id))
 
 		embed = discord.Embed(description=description, 
-							timestamp=datetime.datetime.utcfromtimestamp(game['start_time']), color=self.embed_color)
+							timestamp=datetime.datetime.utcfromtimestamp(game.start_time), color=self.embed_color)
 		embed.set_author(name="Match {}".format(match_id), url="https://www.opendota.com/matches/{}".format(match_id))
 
 		match_image = discord.File(await drawdota.create_match_image(game), filename="matchimage.png")
@@ -473,10 +671,10 @@ class DotaStats(MangoCog):
 		if player is None:
 			player = ctx.message.author.mention
 
-		player_data = next(p for p in game['players'] if p['account_id'] == steamid)
-		perspective += "({0}, {1})".format(self.get_pretty_hero(player_data), "Radiant" if player_data['isRadiant'] else "Dire")
+		player_data = game.get_player(steamid)
+		perspective += "({0}, {1})".format(self.get_pretty_hero(player_data), "Radiant" if player_data.is_radiant else "Dire")
 
-		await self.tell_match_story(game, player_data['isRadiant'], ctx, perspective)
+		await self.tell_match_story(game, player_data.is_radiant, ctx, perspective)
 
 
 	@commands.command(aliases=["whois"])
@@ -489,11 +687,11 @@ class DotaStats(MangoCog):
 		await ctx.channel.trigger_typing()
 
 		playerinfo = await opendota_query(f"/players/{steam32}")
-		matches = await opendota_query(f"/players/{steam32}/matches")
+		await sync_history(steam32)
 
-		gamesplayed = len(matches)
+		gamesplayed, wins = await matchstore.run(matchstore.get_player_totals, steam32)
 		if gamesplayed > 0:
-			winrate = "{:.2%}".format(len(list(filter(lambda m: m['radiant_win'] == (m['player_slot'] < 128), matches))) / gamesplayed)
+			winrate = "{:.2%}".format(wins / gamesplayed)
 		else:
 			winrate = "0%"
 		if playerinfo.get("solo_competitive_rank") is not None:
@@ -501,10 +699,7 @@ class DotaStats(MangoCog):
 		else:
 			solommr = "not publicly displayed"
 
-		heroes = {}
-		for match in matches:
-			heroes[match['hero_id']] = heroes.get(match['hero_id'], 0) + 1
-		heroes = sorted(heroes.items(), key=lambda x: x[1], reverse=True)
+		heroes = await matchstore.run(matchstore.get_hero_counts, steam32)
 		favs = ""
 		for i in range(0,3):
 			if i < len(heroes):
@@ -515,11 +710,7 @@ class DotaStats(MangoCog):
 		# Recent means 2 months / 60 days 
 		timecutoff = time.time() - (86400 * 60)
 
-		heroes = {}
-		for match in matches:
-			if match['start_time'] > timecutoff:
-				heroes[match['hero_id']] = heroes.get(match['hero_id'], 0) + 1
-		heroes = sorted(heroes.items(), key=lambda x: x[1], reverse=True)
+		heroes = await matchstore.run(matchstore.get_hero_counts, steam32, timecutoff)
 		recent_favs = ""
 		for i in range(0,3):
 			if i < len(heroes):
@@ -527,33 +718,10 @@ class DotaStats(MangoCog):
 					recent_favs += ", "
 				recent_favs += self.hero_info[heroes[i][0]]['name']
 
-		recent_count = 0
-		activity_delta = []
-		activity_count = []
-		count = 1
-		for i in range(0, len(matches) - 1):
-			delta = matches[i]["start_time"] - (matches[i + 1]["start_time"] + matches[i]["duration"])
-			if delta < (60 * 60 * 2): # If these are part of the same group
-				count += 1
-				continue
-			else:
-				activity_count.append(count)
-				activity_delta.append(delta)
-				count = 1
-				if matches[i]["start_time"] > timecutoff:
-					recent_count += 1
-
-		if not activity_delta:
-			activity_delta = [ 0 ]
-			activity_count = [ 0 ]
-
-		overall_activity_delta = get_pretty_time((int(statistics.mean(activity_delta)) // 60) * 60)
-		if recent_count:
-			recent_activity_delta = get_pretty_time((int(statistics.mean(activity_delta[:recent_count])) // 60) * 60)
-		else:
-			recent_activity_delta = None
-		# overall_activity_count = int(statistics.mean(activity_count))
-		# recent_activity_count = int(statistics.mean(activity_count[:recent_count]))
+		overall_gap = await matchstore.run(matchstore.get_average_gap, steam32)
+		overall_activity_delta = get_pretty_time((int(overall_gap) // 60) * 60) if overall_gap is not None else None
+		recent_gap = await matchstore.run(matchstore.get_average_gap, steam32, timecutoff)
+		recent_activity_delta = get_pretty_time((int(recent_gap) // 60) * 60) if recent_gap is not None else None
 
 		embed = discord.Embed(color=self.embed_color)
 
@@ -606,28 +774,20 @@ class DotaStats(MangoCog):
 			await thinker.think(ctx.message)
 
 			playerinfo = await opendota_query(f"/players/{steam32}")
-			matches_info = await opendota_query(f"/players/{steam32}/matches")
-			player_matches = []
-			matches = []
-			i = 0
-			while i < len(matches_info) and len(player_matches) < 20:
-				if matches_info[i].get('version', None) is not None:
-					match = await get_match(matches_info[i]['match_id'])
-					player_matches.append(next(p for p in match['players'] if p['account_id'] == steam32))
-					matches.append(match)
-					
-					player_matches[-1]['party_size'] = 0
-					for player in match['players']:
-						if player['party_id'] == player_matches[-1]['party_id']:
-							player_matches[-1]['party_size'] = player_matches[-1].get('party_size', 0) + 1
-				i += 1
+			await sync_history(steam32)
+			matches_info = await matchstore.run(matchstore.get_history, steam32, [ "match_id", "version" ])
+			match_ids = [ m['match_id'] for m in matches_info if m.get('version', None) is not None ]
+			match_ids = await store_parsed_matches(match_ids, 20)
+			player_matches = await matchstore.run(matchstore.get_player_matches, steam32, match_ids, playerstats_columns)
+			# leave out missing values, like get_match does, so they count as 0 like they did on the json
+			player_matches = [ { key: value for key, value in player.items() if value is not None } for player in player_matches ]
 
 		await thinker.stop_thinking(ctx.message)
-		if len(matches) < 2:
+		if len(player_matches) < 2:
 			await ctx.send("Not enough parsed matches!")
 			return
 
-		embed = discord.Embed(description=f"*The following are averages and percentages based on the last {len(matches)} parsed matches*", color=self.embed_color)
+		embed = discord.Embed(description=f"*The following are averages and percentages based on the last {len(player_matches)} parsed matches*", color=self.embed_color)
 
 		embed.set_author(
 			name=playerinfo["profile"]["personaname"], 
@@ -663,21 +823,18 @@ class DotaStats(MangoCog):
 		message_count = 0
 		longest_message = None
 		longest_message_match_id = None
-		for match in matches:
-			player = next(p for p in match['players'] if p['account_id'] == steam32)
-			for message in match['chat']:
-				if message.get('player_slot', -1) == player['player_slot']:
-					if message["type"] == "chat":
-						message_count += 1
-						if longest_message is None or len(longest_message) <= len(message['key']):
-							longest_message = message['key']
-							longest_message_match_id = match['match_id']
-					elif message["type"] == "chatwheel":
-						msg_id = int(message['key'])
-						chat_wheel_counts[msg_id] = chat_wheel_counts.get(msg_id, 0) + 1
-						chat_wheel_total += 1
-
-		message_count = int(round(message_count / len(matches)))
+		for match_id, message_type, key in await matchstore.run(matchstore.get_player_chat, steam32, match_ids):
+			if message_type == "chat":
+				message_count += 1
+				if longest_message is None or len(longest_message) <= len(key):
+					longest_message = key
+					longest_message_match_id = match_id
+			elif message_type == "chatwheel":
+				msg_id = int(key)
+				chat_wheel_counts[msg_id] = chat_wheel_counts.get(msg_id, 0) + 1
+				chat_wheel_total += 1
+
+		message_count = int(round(message_count / len(player_matches)))
 		if longest_message is not None:
 			longest_message = f"\"{longest_message}\""
 			longest_message_heading = f"[{longest_message_heading}](https://www.opendota.com/matches/{longest_message_match_id}/chat)"
@@ -781,30 +938,30 @@ class DotaStats(MangoCog):
 				"name": "safe lane",
 				"keywords": [ "safe" ] ,
 				"url_query": "&lane_role=1",
-				"filter": lambda p: p.get('lane_role') == 1 and not p.get('is_roaming')
+				"lane": 1
 			},
 			{
 				"name": "mid lane",
 				"keywords": [ "mid", "middle" ],
 				"url_query": "&lane_role=2",
-				"filter": lambda p: p.get('lane_role') == 2 and not p.get('is_roaming')
+				"lane": 2
 			},
 			{
 				"name": "offlane",
 				"keywords": [ "off", "hard" ],
 				"url_query": "&lane_role=3",
-				"filter": lambda p: p.get('lane_role') == 3 and not p.get('is_roaming')
+				"lane": 3
 			},
 			{
 				"name": "jungle",
 				"keywords": [ "jungle", "jungling" ],
 				"url_query": "&lane_role=4",
-				"filter": lambda p: p.get('lane_role') == 4 and not p.get('is_roaming')
+				"lane": 4
 			},
 			{
 				"name": "roaming",
 				"keywords": [ "roaming", "roam", "gank", "ganking" ],
-				"filter": lambda p: p.get('is_roaming')
+				"lane": roaming_lane
 			}
 		]
 
@@ -823,61 +980,40 @@ class DotaStats(MangoCog):
 			await ctx.send(f"You have to give me a hero")
 			return
 
-		hero = self.lookup_hero(hero_text)
+		hero = await self.lookup_hero(hero_text)
 		if not hero:
 			await ctx.send(f"I'm not sure what hero \"*{hero_text}*\" is.")
 			return
 
-		projections = [ "kills", "deaths", "assists", "hero_id", "version", "lane_role", "is_roaming" ]
-		projections = map(lambda p: f"project={p}", projections)
-		projections = "&".join(projections)
-
-		queryargs = f"?hero_id={hero.id}&{projections}"
-
 		await ctx.channel.trigger_typing()
 		await thinker.think(ctx.message)
 		playerinfo = await opendota_query(f"/players/{steam32}")
-		matches = await opendota_query(f"/players/{steam32}/matches{queryargs}")
+		await sync_history(steam32)
+		lanes = await matchstore.run(matchstore.get_hero_lanes, steam32, hero.id)
 		await thinker.stop_thinking(ctx.message)
 
 		if chosen_lane:
-			matches = list(filter(chosen_lane["filter"], matches))
+			lanes = { lane: totals for lane, totals in lanes.items() if lane == chosen_lane["lane"] }
 
-		if len(matches) == 0:
+		def total(key):
+			return sum(totals[key] for totals in lanes.values())
+
+		games = total("games")
+		if games == 0:
 			if not chosen_lane:
 				await ctx.send(f"Looks like you haven't played {hero.localized_name}")
 			else:
 				await ctx.send(f"Looks like you haven't played any parsed matches as {hero.localized_name} in {chosen_lane['name']}")
 			return
 
-		lane_parsed_count = len(list(filter(lambda p: p['lane_role'] is not None, matches)))
+		# lane 0 is the matches that aren't parsed, so we don't know what lane they were in
+		lane_parsed_count = sum(totals["games"] for lane, totals in lanes.items() if lane != 0)
 
-		def avg(key, parsed=False, round_place=0):
-			x = 0
-			for match in matches:
-				if parsed and not match['version']:
-					continue
-				if isinstance(key, LambdaType):
-					val = key(match)
-				else:
-					val = match.get(key, 0)
-				x += val
-			x = round(x / (len(matches) if not parsed else lane_parsed_count), round_place)
-			return int(x) if round_place == 0 else x
+		def avg(key):
+			return int(round(total(key) / games))
 
-		def percent(key, parsed=False, round_place=0):
-			count = 0
-			for match in matches:
-				if parsed and not match['version']:
-					continue
-				if isinstance(key, LambdaType):
-					success = key(match)
-				else:
-					success = match.get(key, 0)
-				if success:
-					count += 1
-			count = round((count * 100) / (len(matches) if not parsed else lane_parsed_count), round_place)
-			return int(count) if round_place == 0 else count
+		def lane_percent(lane):
+			return int(round((lanes.get(lane, {}).get("games", 0) * 100) / lane_parsed_count))
 
 
 		url = f"https://www.opendota.com/players/{steam32}/matches?hero_id={hero.id}"
@@ -885,8 +1021,8 @@ class DotaStats(MangoCog):
 			url += chosen_lane.get("url_query", "")
 
 		embed = discord.Embed(description=(
-			f"[Games Played]({url}): **{len(matches)}**\n"
-			f"Winrate: **{percent(lambda p: p['radiant_win'] == (p['player_slot'] < 128), round_place=2)}%**\n"
+			f"[Games Played]({url}): **{games}**\n"
+			f"Winrate: **{round((total('wins') * 100) / games, 2)}%**\n"
 			f"Avg KDA: **{avg('kills')}**/**{avg('deaths')}**/**{avg('assists')}**\n"), color=self.embed_color)
 
 
@@ -898,17 +1034,17 @@ class DotaStats(MangoCog):
 		embed.set_thumbnail(url=self.hero_info[hero.id]['portrait'])
 
 		if (not chosen_lane) and lane_parsed_count > 0:
-			lanes = {
-				"Safe Lane": percent(lambda p: p.get('lane_role') == 1 and not p.get('is_roaming'), parsed=True),
-				"Mid Lane": percent(lambda p: p.get('lane_role') == 2 and not p.get('is_roaming'), parsed=True),
-				"Off Lane": percent(lambda p: p.get('lane_role') == 3 and not p.get('is_roaming'), parsed=True),
-				"Jungle": percent(lambda p: p.get('lane_role') == 4 and not p.get('is_roaming'), parsed=True),
-				"Roaming": percent(lambda p: p.get('is_roaming'), parsed=True)
+			lane_percents = {
+				"Safe Lane": lane_percent(1),
+				"Mid Lane": lane_percent(2),
+				"Off Lane": lane_percent(3),
+				"Jungle": lane_percent(4),
+				"Roaming": lane_percent(roaming_lane)
 			}
 			values = []
-			for lane in lanes:
-				if lanes[lane] > 0:
-					values.append(f"{lane}: **{lanes[lane]}%**")
+			for lane in lane_percents:
+				if lane_percents[lane] > 0:
+					values.append(f"{lane}: **{lane_percents[lane]}%**")
 			embed.add_field(name=f"Laning ({lane_parsed_count} parsed match{'es' if lane_parsed_count > 1 else ''})", value="\n".join(values))
 
 		await ctx.send(embed=embed)
@@ -978,6 +1114,111 @@ class DotaStats(MangoCog):
 
 		await ctx.send(embed=embed, file=image)
 
+	@commands.command(aliases=["heromatchup"])
+	async def matchup(self, ctx, *, heroes):
+		"""Shows how two heroes have done against and with each other
+
+		This is worked out from all of the matches that mangobyte has looked at for the people that use it, so heroes that aren't played much around here won't have many games.
+
+		**Example:**
+		`{cmdpfx}matchup tinker axe`
+		`{cmdpfx}matchup anti mage queen of pain`
+		"""
+		words = heroes.split(" ")
+		hero_ids = None
+		# the heroes' names can have spaces in them, so try each place the words could be split between the two heroes
+		for i in range(1, len(words)):
+			hero_id = self.lookup_hero_id(" ".join(words[:i]))
+			other_hero_id = self.lookup_hero_id(" ".join(words[i:]))
+			if hero_id and other_hero_id:
+				hero_ids = hero_id, other_hero_id
+				break
+		if hero_ids is None:
+			raise UserError(f"I couldn't find two heroes in \"*{heroes}*\". Try something like `?matchup tinker axe`")
+		if hero_ids[0] == hero_ids[1]:
+			raise UserError("🙄 ...Try giving me two different heroes...")
+
+		hero, other_hero = [ await self.lookup_hero(hero_id) for hero_id in hero_ids ]
+		matchup = await matchstore.run(matchstore.get_matchup, hero.id, other_hero.id)
+
+		def winrate(wins, games):
+			if games == 0:
+				return "*No games found*"
+			return f"Won {wins} of {games} {s_if_plural('game', games)} ({wins / games:.0%})"
+
+		embed = discord.Embed(color=self.embed_color)
+		embed.set_author(name=f"{hero.localized_name} + {other_hero.localized_name}")
+		embed.add_field(name=f"{hero.localized_name} against {other_hero.localized_name}",
+			value=winrate(matchup["wins_against"], matchup["games_against"]))
+		embed.add_field(name=f"{hero.localized_name} with {other_hero.localized_name}",
+			value=winrate(matchup["wins_with"], matchup["games_with"]))
+
+		image = discord.File(await drawdota.combine_image_halves(self.hero_info[hero.id]["image"], self.hero_info[other_hero.id]["image"]), "matchup.png")
+		embed.set_thumbnail(url=f"attachment://{image.filename}")
+		await ctx.send(embed=embed, file=image)
+
+	# gets the recent stats of the guild's linked players, as a dict of discord member -> stats
+	async def get_guild_leaderboard(self, guild):
+		members = {}
+		for userinfo in botdata.userinfo_list():
+			member = guild.get_member(userinfo.discord)
+			if member is not None and userinfo.steam32 is not None:
+				members[member] = userinfo.steam32
+		steam32s = sorted(set(members.values()))
+
+		cached = self.leaderboards.get(guild.id)
+		if cached is not None and cached[1] == steam32s and time.time() - cached[0] < leaderboard_refresh_interval:
+			stats = cached[2]
+		else:
+			await sync_histories(steam32s, leaderboard_refresh_interval)
+			stats = await matchstore.run(matchstore.get_recent_stats, steam32s, int(time.time()) - leaderboard_window)
+			self.leaderboards[guild.id] = (time.time(), steam32s, stats)
+		return { member: stats[steam32] for member, steam32 in members.items() if steam32 in stats }
+
+	@commands.command(aliases=["ranking"])
+	async def leaderboard(self, ctx, metric="winrate"):
+		"""Ranks the linked players in this server
+
+		Ranks everyone in this server who has linked their steam account with `{cmdpfx}setsteam` by how they've done in their matches over the last 30 days. Only players who have played at least 5 matches in that time are ranked.
+
+		The metric to rank by can be one of:
+		`winrate`, `games`, `kda`, `gpm`, `xpm`, `lasthits`
+
+		**Example:**
+		`{cmdpfx}leaderboard gpm`
+		"""
+		if ctx.message.guild is None:
+			raise UserError("You gotta be in a server to use this command")
+		metric = metric.lower()
+		if metric not in leaderboard_metrics:
+			raise UserError(f"I don't know how to rank by that. Try one of: {', '.join(leaderboard_metrics)}")
+		title, get_value, value_format = leaderboard_metrics[metric]
+
+		await ctx.channel.trigger_typing()
+		await thinker.think(ctx.message)
+		players = await self.get_guild_leaderboard(ctx.message.guild)
+		await thinker.stop_thinking(ctx.message)
+
+		ranked = []
+		for member, stats in players.items():
+			if stats["games"] >= leaderboard_min_games:
+				value = get_value(stats)
+				if value is not None:
+					ranked.append((value, member, stats))
+		if not ranked:
+			raise UserError(f"Nobody here has played at least {leaderboard_min_games} matches in the last 30 days")
+		ranked.sort(key=lambda r: r[0], reverse=True)
+
+		lines = []
+		for i, (value, member, stats) in enumerate(ranked[:10]):
+			lines.append(f"**{i + 1}.** {member.display_name}: {value_format.format(value)} ({stats['games']} {s_if_plural('game', stats['games'])})")
+
+		embed = discord.Embed(description="\n".join(lines), color=self.embed_color)
+		embed.set_author(name=f"{title} Leaderboard for {ctx.message.guild.name}")
+		embed.set_footer(text=f"Over the last 30 days, for players with at least {leaderboard_min_games} matches")
+		await ctx.send(embed=embed)
+
+
 
 	@commands.command()
 	async def parse(self, ctx, match_id : int):
@@ -990,32 +1231,25 @@ class DotaStats(MangoCog):
 		await ctx.send("⏳ Requesting a parse...", delete_after=5)
 
 		try:
-			data = await httpgetter.post(f"https://api.opendota.com/api/request/{match_id}", errors=opendota_html_errors)
+			await self.parse_tracker.parse(match_id)
 		except HttpError as e:
 			await ctx.message.remove_reaction("⏳", self.bot.user)
 			if e.code == 400:
 				await ctx.send("❌ Looks like that's not a valid match id")
 				return
 			raise
-
-		if data.get("status") == "failed" or data.get("err") is not None:
+		except ParseRequestError as e:
 			await ctx.message.remove_reaction("⏳", self.bot.user)
-			await ctx.send(f"❌ There was an error requesting the parse for match {match_id}")
+			await ctx.send(e.message)
+			return
+		except asyncio.TimeoutError:
+			await ctx.message.remove_reaction("⏳", self.bot.user)
+			await ctx.send(f"❌ Parsing of match {match_id} is taking too long, so I've stopped waiting for it")
 			return
 
-		jobId = data["job"]["jobId"]
-		await asyncio.sleep(3)
-
-		while True:
-			data = await opendota_query(f"/request/{jobId}", False)
-
-			if data is not None:
-				await asyncio.sleep(3)
-			else:
-				await ctx.message.remove_reaction("⏳", self.bot.user)
-				await ctx.message.add_reaction("✅")
-				await ctx.send(f"✅ Parsing of match {match_id} has completed!", delete_after=10)
-				return
+		await ctx.message.remove_reaction("⏳", self.bot.user)
+		await ctx.message.add_reaction("✅")
+		await ctx.send(f"✅ Parsing of match {match_id} has completed!", delete_after=10)
 
 
 
@@ -1,7 +1,7 @@
 import discord
 from discord.ext import commands
 from discord.ext.commands.bot import _mention_pattern, _mentions_transforms
-from __main__ import settings, botdata, invite_link, httpgetter, loggingdb_session
+from __main__ import settings, botdata, invite_link, httpgetter, loggingdb_session, loop_monitor
 from cogs.utils.helpers import *
 from cogs.utils import checks
 from cogs.audio import AudioPlayerNotFoundError
@@ -151,6 +151,8 @@ class General(MangoCog):
 				f"`?{top_commands_weekly[1][0]}`\n"
 				f"`?{top_commands_weekly[2][0]}`\n"))
 
+		embed.add_field(name="Loop Stalls", value=f"{loop_monitor.average_stall() * 1000:.1f}ms avg, {loop_monitor.max_stall() * 1000:.0f}ms max")
+
 		await ctx.send(embed=embed)
 
 	@commands.command()
@@ -32,7 +32,9 @@ class MangoCog:
 		if not match:
 			raise MissingClipType(clipid)
 
-		return cliptypes[match.group(1)](match.group(2), self.bot, ctx)
+		clip = cliptypes[match.group(1)](match.group(2), self.bot, ctx)
+		await clip.load()
+		return clip
 
 
 	async def play_clip(self, clip, ctx):
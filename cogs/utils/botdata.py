@@ -76,7 +76,8 @@ class UserInfo(BotDataItem):
 		BotDataItem.__init__(self, botdata, "userinfo", { "discord": discord }, OrderedDict([
 			("steam32", None),
 			("intro", ""),
-			("outro", "")
+			("outro", ""),
+			("watchmatches", False)
 		]))
 	
 class GuildInfo(BotDataItem):
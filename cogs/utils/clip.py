@@ -1,14 +1,60 @@
 from abc import ABCMeta, abstractmethod
 from __main__ import settings, botdata
 from .helpers import *
+from .loudness import ClipGains, loudness_meter_filter
 from gtts import gTTS
 import urllib.request
 import discord
 import re
 import os
-import random
 import html
 import requests
+import subprocess
+import threading
+import math
+import sys
+from io import BytesIO
+
+clip_gains = ClipGains(settings.resource("clips/gains.json"))
+
+class BytesFFmpegPCMAudio(discord.FFmpegPCMAudio):
+	"""An ffmpeg audio source for audio that is only in memory
+
+	ffmpeg's stdin has to be a real pipe, so the bytes are written into it from a thread"""
+	def __init__(self, data, **kwargs):
+		discord.FFmpegPCMAudio.__init__(self, subprocess.PIPE, pipe=True, **kwargs)
+		threading.Thread(target=self.write_data, args=(self._process.stdin, data), daemon=True).start()
+
+	def write_data(self, stdin, data):
+		try:
+			stdin.write(data)
+			stdin.close()
+		except (OSError, ValueError):
+			# ffmpeg was stopped before it read all of it, like when the clip gets skipped
+			pass
+
+class MeasuredFFmpegPCMAudio(discord.FFmpegPCMAudio):
+	"""An ffmpeg audio source that also measures the loudness of the audio as it plays, so that a remote clip is only downloaded once
+
+	on_measured(loudness) is called from another thread once all of the audio has played, with None if it couldn't be measured"""
+	def __init__(self, source, audio_filter, on_measured, **kwargs):
+		discord.FFmpegPCMAudio.__init__(self, source, stderr=subprocess.PIPE, options=f"-af '{loudness_meter_filter},{audio_filter}'", **kwargs)
+		threading.Thread(target=self.read_meter, args=(self._process, on_measured), daemon=True).start()
+
+	def read_meter(self, process, on_measured):
+		loudness = None
+		try:
+			for line in process.stderr:
+				line = line.decode("utf-8", "replace")
+				if line.startswith("lavfi.r128.I="):
+					loudness = float(line.split("=", 1)[1])
+				elif not line.startswith("frame:"):
+					sys.stderr.write(line) # ffmpeg's own warnings, which would otherwise have gone straight to stderr
+		except (OSError, ValueError):
+			return
+		# ffmpeg gets killed if the clip is stopped early, and then only part of it was measured
+		if process.wait() == 0:
+			on_measured(loudness if loudness is not None and math.isfinite(loudness) else None)
 
 # Clip helper functions
 def get_clipfile(clipname):
@@ -18,11 +64,13 @@ def get_clipfile(clipname):
 				return os.path.join(root, file)
 	return None
 
-def tts_save(filename, text, lang="en-au"):
-	# run_command(["pico2wave", "--wave", filename, "-l", "en-GB", text])
+# gets the mp3 data for the given text, without touching the filesystem
+def tts_data(text, lang="en-au"):
 	try:
 		tts = gTTS(text=text, lang=lang)
-		tts.save(filename)
+		fp = BytesIO()
+		tts.write_to_fp(fp)
+		return fp.getvalue()
 	except AttributeError:
 		raise UserError("Whoops. Looks like gtts is broken right now.")
 	except (RecursionError, requests.exceptions.HTTPError):
@@ -56,13 +104,44 @@ class Clip(object):
 	def clipid(self):
 		return "{}:{}".format(self.type(), self.name)
 
+	# the ffmpeg audio filter that brings this clip to the target loudness
+	# falls back to the clip's default volume if the clip hasn't been measured yet, or has no audiopath to measure
+	@property
+	def audio_filter(self):
+		gain = clip_gains.get(self.audiopath) if self.audiopath is not None else None
+		if gain is None:
+			return f"volume={self.volume}"
+		return f"volume={gain}dB"
+
 	@property
 	def audiolength(self):
 		return round(float(run_command(["ffprobe", "-i", self.audiopath, "-show_entries", "format=duration", "-v", "quiet", "-of", "csv=p=0"])), 2)
 
+	# the file extension of the audio, used when sending the clip as a file
+	@property
+	def extension(self):
+		return os.path.splitext(self.audiopath)[1]
+
+	# creates the audio source that ffmpeg decodes to play this clip
+	# if the clip hasn't been measured yet, it is measured as it plays, and on_measured(audiopath, loudness) is called from another thread after
+	def create_source(self, on_measured=None):
+		if on_measured is not None and self.audiopath not in clip_gains:
+			return MeasuredFFmpegPCMAudio(self.audiopath, self.audio_filter, lambda loudness: on_measured(self.audiopath, loudness))
+		return discord.FFmpegPCMAudio(self.audiopath, options=f"-af {self.audio_filter}")
+
+	# gets a file object for the audio, for sending the clip as a file
+	def open_audio(self):
+		if re.match(r"^https?://", self.audiopath):
+			return urllib.request.urlopen(self.audiopath)
+		return open(self.audiopath, "rb")
+
 	async def get_info(self):
 		return self.text if self.text is not None else ""
 
+	# does any loading that has to be awaited, like database queries. called by get_clip after the clip is created
+	async def load(self):
+		pass
+
 
 class LocalClip(Clip):
 	def __init__(self, clipname, bot, ctx):
@@ -109,18 +188,33 @@ class LocalClip(Clip):
 
 class TtsClip(Clip):
 	def __init__(self, text, bot, ctx):
-		tempfile = settings.resource("temp/{}.wav".format(int(random.random() * 1000000000)))
 		data = botdata.guildinfo(ctx)
 		if data:
-			tts_save(tempfile, text, data.ttslang)
+			self.audiodata = tts_data(text, data.ttslang)
 		else:
-			tts_save(tempfile, text)
-		Clip.__init__(self, text, tempfile, text)
+			self.audiodata = tts_data(text)
+		# the audio is only in memory, so there is no audiopath. it is piped into ffmpeg in create_source
+		Clip.__init__(self, text, None, text)
 
 	@classmethod
 	def type(cls):
 		return "tts"
 
+	@property
+	def audiolength(self):
+		return round(float(run_command(["ffprobe", "-i", "pipe:0", "-show_entries", "format=duration", "-v", "quiet", "-of", "csv=p=0"], input=self.audiodata)), 2)
+
+	@property
+	def extension(self):
+		return ".mp3"
+
+	# the audio is piped straight into ffmpeg from memory, so we never write a temp file
+	def create_source(self, on_measured=None):
+		return BytesFFmpegPCMAudio(self.audiodata, options=f"-af {self.audio_filter}")
+
+	def open_audio(self):
+		return BytesIO(self.audiodata)
+
 
 class UrlClip(Clip):
 	def __init__(self, url, bot, ctx):
@@ -139,11 +233,16 @@ class UrlClip(Clip):
 
 class DotaClip(Clip):
 	def __init__(self, responsename, bot, ctx):
-		dotabase = bot.get_cog("Dotabase")
-		self.response = dotabase.get_response(responsename)
+		self.dotabase = bot.get_cog("Dotabase")
+		self.response = None
+		Clip.__init__(self, responsename, None, volume=0.4)
+
+	async def load(self):
+		self.response = await self.dotabase.get_response(self.name)
 		if self.response == None:
-			raise ClipNotFound(self.type(), responsename)
-		Clip.__init__(self, responsename, dotabase.vpkurl + self.response.mp3, text=self.response.text, volume=0.4)
+			raise ClipNotFound(self.type(), self.name)
+		self.audiopath = self.dotabase.vpkurl + self.response.mp3
+		self.text = self.response.text
 
 	@classmethod
 	def type(cls):
@@ -0,0 +1,38 @@
+import re
+import random
+
+# normalizes text so that the different ways of typing the same thing give the same key
+def resolver_key(text):
+	text = re.sub(r"[_，]", " ", str(text).lower())
+	text = re.sub(r"[^\w\s]", "", text)
+	return " ".join(text.split())
+
+class ClipResolver:
+	"""An index of text to the clip that best fits it, used by smarttts
+
+	Clips are added with a priority, and for each key only the clips with the lowest priority are kept"""
+	def __init__(self):
+		self.index = {} # key -> (priority, { clipid, ... })
+
+	def __len__(self):
+		return len(self.index)
+
+	def add(self, text, clipid, priority):
+		key = resolver_key(text)
+		if key == "":
+			return
+		entry = self.index.get(key)
+		if entry is None or priority < entry[0]:
+			self.index[key] = (priority, { clipid })
+		elif priority == entry[0]:
+			entry[1].add(clipid)
+
+	# gets the clipid that best fits the text, or None if there isn't one
+	# if there are multiple equally good clips, picks a random one
+	def resolve(self, text):
+		entry = self.index.get(resolver_key(text))
+		if entry is None:
+			return None
+		if len(entry[1]) == 1:
+			return next(iter(entry[1]))
+		return random.choice(list(entry[1]))
@@ -0,0 +1,58 @@
+from .helpers import *
+from collections import namedtuple
+from types import MappingProxyType
+import os
+
+#
+# The lookup tables that we build from dotabase at startup, which are shared by the dotabase and dotastats cogs and drawdota
+# They are saved to a snapshot file, so that later starts can load them from it instead of querying dotabase for them
+#
+
+# bump this when what is stored in the snapshot changes, so that old snapshots get rebuilt
+snapshot_format = 1
+
+ChatWheelSound = namedtuple("ChatWheelSound", [ "id", "name", "message", "label", "sound" ])
+ResponseInfo = namedtuple("ResponseInfo", [ "name", "text", "text_simple", "hero_id", "criteria" ])
+
+# the version of the dotabase db file. changes whenever dotabase is updated
+def dotabase_version(dbfile):
+	stat = os.stat(dbfile)
+	return f"{snapshot_format}-{stat.st_size}-{int(stat.st_mtime)}"
+
+# json only has string keys, so the id keyed tables need their keys converted back
+def int_keys(data):
+	return MappingProxyType({ int(key): value for key, value in data.items() })
+
+class DotaInfo:
+	"""The tables derived from dotabase. These are shared, so nothing should modify them
+
+	hero_infos, item_infos and chat_wheel_infos are id -> info dicts
+	hero_aliases is alias -> hero id, and criteria_aliases is the list of the criteria that are concepts
+	hero_names and ability_names are lists of (id, localized_name)"""
+	def __init__(self, data):
+		self.version = data["version"]
+		self.hero_infos = int_keys(data["hero_infos"])
+		self.item_infos = int_keys(data["item_infos"])
+		self.chat_wheel_infos = int_keys(data["chat_wheel_infos"])
+		self.hero_aliases = MappingProxyType(data["hero_aliases"])
+		self.criteria_aliases = tuple(data["criteria_aliases"])
+		self.hero_names = tuple(map(tuple, data["hero_names"]))
+		self.ability_names = tuple(map(tuple, data["ability_names"]))
+		self.chatwheel_sounds = tuple(ChatWheelSound(*sound) for sound in data["chatwheel_sounds"])
+		self.responses = tuple(ResponseInfo(*response) for response in data["responses"])
+
+	# loads the info from the snapshot file if it was made from this version of dotabase, otherwise builds it and saves a new snapshot
+	# build should return the data dict for the given version
+	@classmethod
+	def load(cls, filename, version, build):
+		start = time.perf_counter()
+		if os.path.isfile(filename):
+			data = read_json(filename)
+			if data.get("version") == version:
+				print(f"dotabase info loaded from snapshot in {(time.perf_counter() - start) * 1000:.0f}ms")
+				return cls(data)
+		data = build(version)
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		write_json(filename, data)
+		print(f"dotabase info built and snapshotted in {(time.perf_counter() - start) * 1000:.0f}ms")
+		return cls(data)
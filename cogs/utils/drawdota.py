@@ -33,12 +33,16 @@ async def get_item_image(item_id):
 # async def get_item_image(item_id):
 # 	return Image.open(item_infos[item_id]["icon"])
 
-async def get_item_images(player):
-	images = []
-	for i in range(0, 6):
-		item = player.get(f"item_{i}")
-		if item:
-			images.append(await get_item_image(item))
+# gets all of the hero and item images that the match table needs at once, fetching each image only once
+# returns dicts of hero_id -> image and item_id -> image
+async def get_match_images(match):
+	hero_ids = list(set(player.hero_id for player in match.players))
+	item_ids = list(set(item for player in match.players for item in player.items if item))
+	images = await asyncio.gather(*[ get_hero_image(hero_id) for hero_id in hero_ids ], *[ get_item_image(item_id) for item_id in item_ids ])
+	return dict(zip(hero_ids, images[:len(hero_ids)])), dict(zip(item_ids, images[len(hero_ids):]))
+
+def get_item_images(player, item_images):
+	images = [ item_images[item] for item in player.items if item ]
 	if len(images) == 0:
 		return None
 
@@ -55,34 +59,35 @@ async def get_item_images(player):
 def get_lane(player):
 	lane_dict = { 1: "Bot", 3: "Top" }
 	lane_role_dict = { 1: "Safe", 2: "Mid", 3: "Off", 4: "Jungle" }
-	if 'is_roaming' in player and player['is_roaming']:
+	if player.is_roaming:
 		return "Roaming"
-	elif player.get('lane') in lane_dict:
-		return f"{lane_role_dict[player['lane_role']]}({lane_dict[player['lane']]})"
+	elif player.lane in lane_dict:
+		return f"{lane_role_dict[player.lane_role]}({lane_dict[player.lane]})"
 	else:
-		return lane_role_dict[player.get('lane_role')]
+		return lane_role_dict[player.lane_role]
 
-async def add_player_row(table, player, is_parsed):
+def add_player_row(table, player, is_parsed, hero_images, item_images):
 	row = [
-		ColorCell(width=5, color=("green" if player["isRadiant"] else "red")),
-		ImageCell(img=await get_hero_image(player["hero_id"]), height=48),
-		TextCell(player.get("personaname", "Anonymous")),
-		TextCell(player.get("kills")),
-		TextCell(player.get("deaths")),
-		TextCell(player.get("assists")),
-		TextCell(player.get("gold_per_min"), color="yellow"),
-		ImageCell(img=await get_item_images(player), height=48)
+		ColorCell(width=5, color=("green" if player.is_radiant else "red")),
+		ImageCell(img=hero_images[player.hero_id], height=48),
+		TextCell(player.personaname if player.personaname is not None else "Anonymous"),
+		TextCell(player.kills),
+		TextCell(player.deaths),
+		TextCell(player.assists),
+		TextCell(player.gold_per_min, color="yellow"),
+		ImageCell(img=get_item_images(player, item_images), height=48)
 	]
 	if is_parsed:
 		row[-1:-1] = [
-			TextCell(player.get("actions_per_min")),
+			TextCell(player.actions_per_min),
 			TextCell(get_lane(player)),
-			TextCell(player.get("pings", "-"), horizontal_align="center")
+			TextCell(player.pings if player.pings is not None else "-", horizontal_align="center")
 		]
 	table.add_row(row)
 
-async def draw_match_table(match):
-	is_parsed = match.get("version")
+# draws the table of the players in the match, with the images from get_match_images
+def draw_match_table(match, hero_images, item_images):
+	is_parsed = match.is_parsed
 	table = Table(background=background_color)
 	# Header
 	headers = [
@@ -106,18 +111,20 @@ async def draw_match_table(match):
 		cell.background = trim_color
 
 	# Do players
-	for player in match["players"]:
-		if player['isRadiant']:
-			await add_player_row(table, player, is_parsed)
+	for player in match.players:
+		if player.is_radiant:
+			add_player_row(table, player, is_parsed, hero_images, item_images)
 	table.add_row([ColorCell(color=trim_color, height=5) for i in range(len(headers))])
-	for player in match["players"]:
-		if not player['isRadiant']:
-			await add_player_row(table, player, is_parsed)
+	for player in match.players:
+		if not player.is_radiant:
+			add_player_row(table, player, is_parsed, hero_images, item_images)
 	return table.render()
 
 async def create_match_image(match):
+	hero_images, item_images = await get_match_images(match)
+
 	table_border = 10
-	table_image = await draw_match_table(match)
+	table_image = draw_match_table(match, hero_images, item_images)
 
 	image = Image.new('RGBA', (table_image.size[0] + (table_border * 2), table_image.size[1] + table_border + 64))
 	draw = ImageDraw.Draw(image)
@@ -125,10 +132,10 @@ async def create_match_image(match):
 	draw.rectangle([0, 64, image.size[0], image.size[1]], fill=trim_color)
 	image.paste(table_image, (table_border, 64))
 
-	title = TextCell(f"{'Radiant' if match['radiant_win'] else 'Dire'} Victory", font_size=48, color=("green" if match['radiant_win'] else "red"))
+	title = TextCell(f"{'Radiant' if match.radiant_win else 'Dire'} Victory", font_size=48, color=("green" if match.radiant_win else "red"))
 	title.render(draw, image, 64, 0, image.size[0] - 64, 64)
 
-	team_icon = Image.open(radiant_icon if match['radiant_win'] else dire_icon).resize((64, 64))
+	team_icon = Image.open(radiant_icon if match.radiant_win else dire_icon).resize((64, 64))
 	temp_image = Image.new("RGBA", image.size)
 	temp_image.paste(team_icon, (0, 0))
 	image = Image.alpha_composite(image, temp_image)
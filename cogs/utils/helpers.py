@@ -3,6 +3,7 @@ import sys
 import json
 import subprocess
 import asyncio
+import time
 from collections import OrderedDict
 
 def findfile(name, path):
@@ -11,8 +12,8 @@ def findfile(name, path):
 			return os.path.join(root, name)
 	return None
 
-def run_command(commandarray):
-	return subprocess.check_output(commandarray, stderr=subprocess.STDOUT).decode("utf-8")
+def run_command(commandarray, input=None):
+	return subprocess.check_output(commandarray, stderr=subprocess.STDOUT, input=input).decode("utf-8")
 
 # Gets mangobytes version from git commit number
 def get_version():
@@ -60,6 +61,31 @@ class Thinker():
 			await asyncio.sleep(1)
 
 
+class LoopMonitor():
+	"""Measures how long the event loop is stalled for, by checking how late a sleep wakes up"""
+	def __init__(self, bot, interval=0.5):
+		self.bot = bot
+		self.interval = interval
+		self.stalls = [] # the most recent stalls, in seconds
+		self.max_stalls = 1000
+		self.bot.loop.create_task(self.monitor_task())
+
+	async def monitor_task(self):
+		await self.bot.wait_until_ready()
+		while not self.bot.is_closed():
+			start = time.perf_counter()
+			await asyncio.sleep(self.interval)
+			self.stalls.append(max(0, time.perf_counter() - start - self.interval))
+			if len(self.stalls) > self.max_stalls:
+				self.stalls.pop(0)
+
+	def average_stall(self):
+		return sum(self.stalls) / len(self.stalls) if self.stalls else 0
+
+	def max_stall(self):
+		return max(self.stalls) if self.stalls else 0
+
+
 class HttpError(UserError):
 	"""An http error with an error code"""
 	def __init__(self, message, code):
@@ -0,0 +1,107 @@
+import time
+import bisect
+import sys
+
+class LookupIndex:
+	"""An index of names to values, for matching user input against names by exact match, prefix, or substring
+
+	Each lookup returns the value of the first name added that matches, which is the same result you'd get from
+	looping over the names in order, but is just a dict lookup"""
+	def __init__(self, substrings=False):
+		self.exact_map = {}
+		self.prefix_map = {}
+		self.substring_map = {} if substrings else None
+
+	def add(self, name, value):
+		self.exact_map.setdefault(name, value)
+		for i in range(1, len(name) + 1):
+			self.prefix_map.setdefault(name[:i], value)
+		if self.substring_map is not None:
+			for i in range(len(name)):
+				for j in range(i + 1, len(name) + 1):
+					self.substring_map.setdefault(name[i:j], value)
+
+	def exact(self, text):
+		return self.exact_map.get(text)
+
+	def prefix(self, text):
+		return self.prefix_map.get(text)
+
+	def substring(self, text):
+		if self.substring_map is None:
+			raise ValueError("This index wasn't built with substrings")
+		return self.substring_map.get(text)
+
+
+class SubstringIndex:
+	"""Finds the first of a list of names that contains some text
+
+	The names are all joined into one string, so finding one is a single str.find instead of a loop"""
+	separator = "\0"
+
+	def __init__(self, names_values):
+		self.starts = []
+		self.values = []
+		names = []
+		position = 0
+		for name, value in names_values:
+			self.starts.append(position)
+			self.values.append(value)
+			names.append(name)
+			position += len(name) + len(self.separator)
+		self.text = self.separator.join(names)
+
+	def find(self, text):
+		if text == "" or self.separator in text:
+			return None
+		index = self.text.find(text)
+		if index == -1:
+			return None
+		return self.values[bisect.bisect_right(self.starts, index) - 1]
+
+
+# the memory used by the index's maps, not counting the values, which are shared with whatever was indexed
+def index_memory(index):
+	maps = [ index.exact_map, index.prefix_map ]
+	if index.substring_map is not None:
+		maps.append(index.substring_map)
+	return sum(sys.getsizeof(m) + sum(sys.getsizeof(key) for key in m) for m in maps)
+
+# Compares the index against looping over the names, for every prefix (or every substring, if substrings is set) of every name
+# run from the repo root with: python3.6 -m cogs.utils.lookupindex
+def benchmark(label, names, substrings=False):
+	index = LookupIndex(substrings=substrings)
+	for name in names:
+		index.add(name, name)
+	if substrings:
+		queries = list(index.substring_map)
+		matches = lambda n, q: q in n
+		lookup = index.substring
+	else:
+		queries = [ name[:i] for name in names for i in range(1, len(name) + 1) ]
+		matches = lambda n, q: n.startswith(q)
+		lookup = index.prefix
+
+	start = time.perf_counter()
+	linear_results = [ next((n for n in names if matches(n, q)), None) for q in queries ]
+	linear_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	index_results = [ lookup(q) for q in queries ]
+	index_time = time.perf_counter() - start
+
+	if linear_results != index_results:
+		raise ValueError("The index gave different results than looping over the names")
+	names_memory = sum(sys.getsizeof(name) for name in names)
+	print(f"{label}: {len(names)} names ({names_memory / 1024:.0f}KB), {len(queries)} {'substring' if substrings else 'prefix'} lookups: "
+		f"loop {linear_time * 1000:.1f}ms, index {index_time * 1000:.1f}ms, index memory {index_memory(index) / 1024:.0f}KB")
+
+if __name__ == '__main__':
+	from dotabase import dotabase_session, Hero, Ability, Item
+	import re
+	session = dotabase_session()
+	benchmark("hero names", [ hero.localized_name.lower() for hero in session.query(Hero) ])
+	aliases = [ alias for hero in session.query(Hero) for alias in hero.aliases.split("|") ]
+	benchmark("hero aliases", list(dict.fromkeys(a for alias in aliases for a in [ alias, alias.replace(" ", "") ])), substrings=True)
+	benchmark("ability names", [ re.sub(r'[^a-z1-9\s]', r'', str(ability.localized_name).lower()) for ability in session.query(Ability) ])
+	benchmark("item names", [ str(item.localized_name).lower() for item in session.query(Item) ])
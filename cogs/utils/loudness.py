@@ -0,0 +1,119 @@
+from .helpers import *
+import os
+import re
+import math
+from collections import OrderedDict
+
+#
+# Measures the loudness of clips (EBU R128 integrated loudness, via ffmpeg's loudnorm filter)
+# and stores the gain needed to bring each clip to the target loudness.
+#
+# The gains for local clips can be precomputed offline by running this from the repo root:
+# python3.6 -m cogs.utils.loudness
+#
+
+target_loudness = -20.0 # LUFS
+max_gain = 12.0 # dB, so that we don't blow up quiet/noisy clips too much
+default_gains_file = "resource/clips/gains.json"
+max_remote_gains = 1000 # the most gains of remote clips (urls) that are kept in memory
+
+# an ffmpeg filter that measures the loudness of the audio going through it, without changing it, so a clip can be measured while it plays
+# for each frame it prints the integrated loudness so far to stderr as lavfi.r128.I=<LUFS>, so the last one is the loudness of the whole clip
+loudness_meter_filter = r"ebur128=metadata=1,ametadata=mode=print:key=lavfi.r128.I:file=pipe\\:2"
+
+# returns the integrated loudness of the given file/url in LUFS, or None if it couldn't be measured
+def measure_loudness(audiopath):
+	try:
+		output = run_command(["ffmpeg", "-hide_banner", "-nostats", "-i", audiopath, "-af", "loudnorm=print_format=json", "-f", "null", "-"])
+	except subprocess.CalledProcessError:
+		return None
+	match = re.search(r"(\{[^{}]*\})\s*$", output)
+	if not match:
+		return None
+	loudness = float(json.loads(match.group(1))["input_i"])
+	if not math.isfinite(loudness):
+		return None
+	return loudness
+
+# the gain in dB needed to bring a clip of the given loudness up/down to the target loudness
+def loudness_gain(loudness):
+	gain = target_loudness - loudness
+	return round(max(-max_gain * 2, min(max_gain, gain)), 2)
+
+def is_remote(audiopath):
+	return re.match(r"^https?://", audiopath) is not None
+
+def clip_key(audiopath):
+	if is_remote(audiopath):
+		return audiopath
+	return os.path.normpath(audiopath)
+
+class ClipGains:
+	"""The gains (in dB) for clips, keyed by the clip's audiopath
+
+	Only the gains of local clips are saved to the gains file. The gains of remote clips (like ?playurl urls) are kept in memory,
+	and only the most recently used max_remote_gains of them are kept"""
+	def __init__(self, filename=default_gains_file):
+		self.filename = filename
+		self.gains = {}
+		self.remote_gains = OrderedDict()
+		self.dirty = False # whether there are local gains that haven't been saved yet
+		if os.path.isfile(self.filename):
+			self.gains = read_json(self.filename)
+
+	def save(self):
+		self.dirty = False
+		write_json(self.filename, dict(self.gains))
+
+	def get(self, audiopath):
+		key = clip_key(audiopath)
+		if key in self.remote_gains:
+			self.remote_gains.move_to_end(key)
+			return self.remote_gains[key]
+		return self.gains.get(key)
+
+	def __contains__(self, audiopath):
+		key = clip_key(audiopath)
+		return key in self.gains or key in self.remote_gains
+
+	# stores the gain for a measured clip. stores None if the clip couldn't be measured, so we dont keep retrying it
+	# local gains are saved if save is True, otherwise they're just marked as needing to be saved
+	def set_loudness(self, audiopath, loudness, save=True):
+		gain = loudness_gain(loudness) if loudness is not None else None
+		key = clip_key(audiopath)
+		if is_remote(key):
+			self.remote_gains[key] = gain
+			self.remote_gains.move_to_end(key)
+			while len(self.remote_gains) > max_remote_gains:
+				self.remote_gains.popitem(last=False)
+			return gain
+		self.gains[key] = gain
+		self.dirty = True
+		if save:
+			self.save()
+		return gain
+
+	def analyze(self, audiopath, save=True):
+		return self.set_loudness(audiopath, measure_loudness(audiopath), save=save)
+
+# gets all of the clip files in the given directory
+def get_clipfiles(clipdir):
+	result = []
+	for root, dirs, files in os.walk(clipdir):
+		for file in files:
+			if file.endswith(".mp3") or file.endswith(".wav"):
+				result.append(os.path.join(root, file))
+	result.sort()
+	return result
+
+# the offline pass, which measures every local clip that doesn't have a gain yet
+def analyze_local_clips(clipdir="resource/clips/", gains_file=default_gains_file, force=False):
+	clip_gains = ClipGains(gains_file)
+	for clipfile in get_clipfiles(clipdir):
+		if force or clipfile not in clip_gains:
+			gain = clip_gains.analyze(clipfile, save=False)
+			print(f"{clipfile}: {gain}")
+	clip_gains.save()
+
+if __name__ == '__main__':
+	analyze_local_clips(force="--force" in sys.argv)
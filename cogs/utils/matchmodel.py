@@ -0,0 +1,144 @@
+import sys
+import json
+import random
+from collections import OrderedDict
+
+#
+# A compact model of the match json from opendota, keeping only the fields that we use
+# The memory comparison against the json can be run from the repo root with:
+# python3.6 -m cogs.utils.matchmodel [match json files]
+#
+
+class KillLog:
+	__slots__ = ("time", "key")
+
+	def __init__(self, data):
+		self.time = data.get("time")
+		self.key = data.get("key")
+
+class Objective:
+	__slots__ = ("type", "time", "player_slot")
+
+	def __init__(self, data):
+		self.type = data.get("type")
+		self.time = data.get("time")
+		self.player_slot = data.get("player_slot")
+
+class TeamfightPlayer:
+	__slots__ = ("deaths", "gold_delta")
+
+	def __init__(self, data):
+		self.deaths = data.get("deaths")
+		self.gold_delta = data.get("gold_delta")
+
+class Teamfight:
+	__slots__ = ("start", "end", "deaths", "players")
+
+	def __init__(self, data):
+		self.start = data.get("start")
+		self.end = data.get("end")
+		self.deaths = data.get("deaths")
+		self.players = [ TeamfightPlayer(player) for player in data.get("players") or [] ]
+
+class Player:
+	__slots__ = ("account_id", "player_slot", "hero_id", "is_radiant", "personaname", "kills", "deaths", "assists",
+		"gold_per_min", "actions_per_min", "lane", "lane_role", "lane_efficiency", "is_roaming", "pings", "items", "kills_log")
+
+	def __init__(self, data):
+		self.account_id = data.get("account_id")
+		self.player_slot = data.get("player_slot")
+		self.hero_id = data.get("hero_id")
+		self.is_radiant = data.get("isRadiant", (self.player_slot or 0) < 128)
+		self.personaname = data.get("personaname")
+		self.kills = data.get("kills")
+		self.deaths = data.get("deaths")
+		self.assists = data.get("assists")
+		self.gold_per_min = data.get("gold_per_min")
+		self.actions_per_min = data.get("actions_per_min")
+		self.lane = data.get("lane")
+		self.lane_role = data.get("lane_role")
+		self.lane_efficiency = data.get("lane_efficiency")
+		self.is_roaming = data.get("is_roaming")
+		self.pings = data.get("pings")
+		self.items = tuple(data.get(f"item_{i}") for i in range(6))
+		self.kills_log = [ KillLog(kill) for kill in data.get("kills_log") or [] ]
+
+class Match:
+	"""A match from opendota, with its players indexed by account_id, player_slot and hero_id"""
+	__slots__ = ("match_id", "version", "start_time", "duration", "radiant_win", "players", "teamfights", "objectives",
+		"players_by_account", "players_by_slot", "players_by_hero")
+
+	def __init__(self, data):
+		self.match_id = data.get("match_id")
+		self.version = data.get("version")
+		self.start_time = data.get("start_time")
+		self.duration = data.get("duration")
+		self.radiant_win = data.get("radiant_win")
+		self.players = [ Player(player) for player in data.get("players") or [] ]
+		self.teamfights = [ Teamfight(teamfight) for teamfight in data.get("teamfights") or [] ]
+		self.objectives = [ Objective(objective) for objective in data.get("objectives") or [] ]
+		self.players_by_account = { p.account_id: p for p in self.players if p.account_id is not None }
+		self.players_by_slot = { p.player_slot: p for p in self.players }
+		self.players_by_hero = { p.hero_id: p for p in self.players }
+
+	@property
+	def is_parsed(self):
+		return self.version is not None
+
+	def get_player(self, account_id):
+		return self.players_by_account.get(account_id)
+
+	def get_player_by_slot(self, player_slot):
+		return self.players_by_slot.get(player_slot)
+
+	def get_player_by_hero(self, hero_id):
+		return self.players_by_hero.get(hero_id)
+
+
+# the total size of an object and everything it refers to, not counting anything counted already
+def deep_sizeof(obj, seen=None):
+	if seen is None:
+		seen = set()
+	if id(obj) in seen:
+		return 0
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+	elif isinstance(obj, (list, tuple, set)):
+		size += sum(deep_sizeof(item, seen) for item in obj)
+	elif hasattr(obj, "__slots__"):
+		size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__)
+	return size
+
+# a match shaped like a parsed match from opendota, for when there aren't any real ones to measure
+def example_match():
+	def player(slot):
+		data = OrderedDict((f"stat_{i}", random.randint(0, 10000)) for i in range(80))
+		data.update(account_id=random.randint(1, 10 ** 9), player_slot=slot, hero_id=slot % 120 + 1, isRadiant=slot < 128,
+			personaname="someone", kills=5, deaths=5, assists=5, gold_per_min=500, actions_per_min=150, lane=1, lane_role=1,
+			lane_efficiency=0.7, is_roaming=False, pings=10)
+		for key in [ "gold_t", "xp_t", "lh_t", "dn_t", "times" ]:
+			data[key] = [ random.randint(0, 30000) for i in range(60) ]
+		data["kills_log"] = [ OrderedDict(time=random.randint(0, 3600), key="npc_dota_hero_axe") for i in range(8) ]
+		data["purchase_log"] = [ OrderedDict(time=random.randint(0, 3600), key="tango") for i in range(40) ]
+		return data
+	return OrderedDict(match_id=1, version=21, start_time=1500000000, duration=2400, radiant_win=True,
+		players=[ player(slot) for slot in [ 0, 1, 2, 3, 4, 128, 129, 130, 131, 132 ] ],
+		teamfights=[ OrderedDict(start=i * 120, end=i * 120 + 30, deaths=3,
+			players=[ OrderedDict(deaths=1, gold_delta=200, xp_delta=100) for p in range(10) ]) for i in range(20) ],
+		objectives=[ OrderedDict(type="CHAT_MESSAGE_FIRSTBLOOD", time=300, player_slot=0) ],
+		chat=[ OrderedDict(time=i * 60, type="chat", player_slot=0, key="gg") for i in range(30) ])
+
+def compare_memory(match_json):
+	json_size = deep_sizeof(match_json)
+	model_size = deep_sizeof(Match(match_json))
+	print(f"match {match_json.get('match_id')}: json {json_size / 1024:.0f}KB, model {model_size / 1024:.0f}KB ({model_size / json_size:.1%})")
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		for filename in sys.argv[1:]:
+			with open(filename, "r") as f:
+				compare_memory(json.loads(f.read(), object_pairs_hook=OrderedDict))
+	else:
+		compare_memory(example_match())
@@ -0,0 +1,622 @@
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, Float, Boolean, Index, func
+from sqlalchemy.orm import sessionmaker, scoped_session
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import asyncio
+
+#
+# A local store of the matches we've gotten from opendota, split up into tables so commands can query just the columns they need
+#
+
+Base = declarative_base()
+
+class Match(Base):
+	__tablename__ = 'matches'
+
+	match_id = Column(Integer, primary_key=True)
+	version = Column(Integer) # None if the match isn't parsed
+	start_time = Column(Integer)
+	duration = Column(Integer)
+	radiant_win = Column(Boolean)
+	lobby_type = Column(Integer)
+	game_mode = Column(Integer)
+	radiant_score = Column(Integer)
+	dire_score = Column(Integer)
+
+class MatchPlayer(Base):
+	__tablename__ = 'match_players'
+
+	match_id = Column(Integer, primary_key=True)
+	player_slot = Column(Integer, primary_key=True)
+	account_id = Column(Integer)
+	personaname = Column(String)
+	hero_id = Column(Integer)
+	isRadiant = Column(Boolean)
+	win = Column(Integer)
+	kills = Column(Integer)
+	deaths = Column(Integer)
+	assists = Column(Integer)
+	last_hits = Column(Integer)
+	denies = Column(Integer)
+	neutral_kills = Column(Integer)
+	gold_per_min = Column(Integer)
+	actions_per_min = Column(Integer)
+	hero_damage = Column(Integer)
+	hero_healing = Column(Integer)
+	tower_damage = Column(Integer)
+	total_gold = Column(Integer)
+	level = Column(Integer)
+	party_id = Column(Integer)
+	party_size = Column(Integer)
+	lane = Column(Integer)
+	lane_role = Column(Integer)
+	lane_efficiency = Column(Float)
+	is_roaming = Column(Boolean)
+	randomed = Column(Boolean)
+	obs_placed = Column(Integer)
+	sen_placed = Column(Integer)
+	pings = Column(Integer)
+	item_0 = Column(Integer)
+	item_1 = Column(Integer)
+	item_2 = Column(Integer)
+	item_3 = Column(Integer)
+	item_4 = Column(Integer)
+	item_5 = Column(Integer)
+
+	__table_args__ = (Index("ix_match_players_account_id", "account_id", "match_id"), )
+
+class ChatMessage(Base):
+	__tablename__ = 'chat_messages'
+
+	match_id = Column(Integer, primary_key=True)
+	index = Column(Integer, primary_key=True) # position in the match's chat log
+	time = Column(Integer)
+	type = Column(String)
+	player_slot = Column(Integer)
+	key = Column(String)
+
+# a match in a player's match history, from /players/{account_id}/matches
+class HistoryMatch(Base):
+	__tablename__ = 'player_history'
+
+	account_id = Column(Integer, primary_key=True)
+	match_id = Column(Integer, primary_key=True)
+	player_slot = Column(Integer)
+	radiant_win = Column(Boolean)
+	hero_id = Column(Integer)
+	start_time = Column(Integer)
+	duration = Column(Integer)
+	game_mode = Column(Integer)
+	lobby_type = Column(Integer)
+	version = Column(Integer)
+	kills = Column(Integer)
+	deaths = Column(Integer)
+	assists = Column(Integer)
+	party_size = Column(Integer)
+	lane_role = Column(Integer)
+	is_roaming = Column(Boolean)
+	gold_per_min = Column(Integer)
+	xp_per_min = Column(Integer)
+	last_hits = Column(Integer)
+
+	__table_args__ = (
+		Index("ix_player_history_start_time", "account_id", "start_time"),
+		Index("ix_player_history_hero_id", "account_id", "hero_id"))
+
+# when each player's history was last synced, and the start time of the latest match we have for them
+class HistorySync(Base):
+	__tablename__ = 'history_syncs'
+
+	account_id = Column(Integer, primary_key=True)
+	synced_at = Column(Integer)
+	latest_start_time = Column(Integer)
+
+# the fields that are stored for each match in a player's history, to ask opendota for
+history_fields = [ column.name for column in HistoryMatch.__table__.columns if column.name != "account_id" ]
+
+
+#
+# Rollups of each player's history, kept up to date as matches are added to it, so commands don't have to go over every match
+#
+
+# the lane of a history match for the rollups. roaming counts as its own lane, and unparsed matches (with no lane_role) are lane 0
+roaming_lane = 5
+def history_lane(match):
+	if match.get("lane_role") is None:
+		return 0
+	if match.get("is_roaming"):
+		return roaming_lane
+	return match["lane_role"]
+
+# matches less than this many seconds apart are part of the same group of games
+group_gap = 60 * 60 * 2
+
+class PlayerTotals(Base):
+	__tablename__ = 'player_totals'
+
+	account_id = Column(Integer, primary_key=True)
+	games = Column(Integer)
+	wins = Column(Integer)
+
+# the player's totals for each hero in each lane
+class PlayerHeroLane(Base):
+	__tablename__ = 'player_hero_lanes'
+
+	account_id = Column(Integer, primary_key=True)
+	hero_id = Column(Integer, primary_key=True)
+	lane = Column(Integer, primary_key=True)
+	games = Column(Integer)
+	wins = Column(Integer)
+	kills = Column(Integer)
+	deaths = Column(Integer)
+	assists = Column(Integer)
+	last_played = Column(Integer)
+
+# the number of games the player played as each hero on each day (start_time // 86400)
+class PlayerHeroDay(Base):
+	__tablename__ = 'player_hero_days'
+
+	account_id = Column(Integer, primary_key=True)
+	hero_id = Column(Integer, primary_key=True)
+	day = Column(Integer, primary_key=True)
+	games = Column(Integer)
+
+# the gaps between the player's groups of games, keyed by the start time of the game after the gap
+class PlayerGap(Base):
+	__tablename__ = 'player_gaps'
+
+	account_id = Column(Integer, primary_key=True)
+	start_time = Column(Integer, primary_key=True)
+	delta = Column(Integer)
+
+class PlayerAggregates:
+	"""Changes to one player's rollups, collected in memory and then applied to only the rows that they touch
+
+	If rebuild is set, all of the player's rollups are replaced with what was added, instead of being changed by it"""
+	def __init__(self, session, account_id, rebuild=False):
+		self.session = session
+		self.account_id = account_id
+		self.rebuild = rebuild
+		self.totals = [ 0, 0 ] # games, wins
+		self.hero_lanes = {} # (hero_id, lane) -> [ games, wins, kills, deaths, assists, last_played ]
+		self.hero_days = {} # (hero_id, day) -> games
+		self.gaps = {} # start_time -> delta, of the gaps to add
+		self.rebuild_gaps = rebuild # whether self.gaps replaces all of the player's gaps
+
+	# whether the player has any rollups yet
+	@staticmethod
+	def exist(session, account_id):
+		return session.query(PlayerTotals.account_id).filter(PlayerTotals.account_id == account_id).first() is not None
+
+	# adds the match to the rollups, or takes it out of them if sign is -1
+	def add(self, match, sign=1):
+		win = int((match["player_slot"] < 128) == bool(match.get("radiant_win")))
+		self.totals[0] += sign
+		self.totals[1] += sign * win
+		stats = self.hero_lanes.setdefault((match["hero_id"], history_lane(match)), [ 0, 0, 0, 0, 0, 0 ])
+		stats[0] += sign
+		stats[1] += sign * win
+		stats[2] += sign * (match.get("kills") or 0)
+		stats[3] += sign * (match.get("deaths") or 0)
+		stats[4] += sign * (match.get("assists") or 0)
+		stats[5] = max(stats[5], match["start_time"])
+		day = (match["hero_id"], match["start_time"] // 86400)
+		self.hero_days[day] = self.hero_days.get(day, 0) + sign
+
+	# adds the gaps between the given matches, which must all be newer than the previous latest match
+	def add_gaps(self, matches, previous):
+		for match in sorted(matches, key=lambda m: m["start_time"]):
+			if previous is not None:
+				delta = match["start_time"] - (previous + (match.get("duration") or 0))
+				if delta >= group_gap:
+					self.gaps[match["start_time"]] = delta
+			previous = match["start_time"]
+
+	# the player's existing rows in the table for the heroes that have changed, keyed by their primary key
+	def get_rows(self, table, key_column, keys):
+		hero_ids = set(hero_id for hero_id, key in keys)
+		if self.rebuild or not hero_ids:
+			return {}
+		query = self.session.query(table).filter(table.account_id == self.account_id, table.hero_id.in_(hero_ids))
+		return { (row.hero_id, getattr(row, key_column)): row for row in query }
+
+	def save(self):
+		if self.rebuild:
+			for table in [ PlayerTotals, PlayerHeroLane, PlayerHeroDay ]:
+				self.session.query(table).filter(table.account_id == self.account_id).delete()
+
+		totals = None if self.rebuild else self.session.query(PlayerTotals).filter(PlayerTotals.account_id == self.account_id).first()
+		if totals is None:
+			self.session.add(PlayerTotals(account_id=self.account_id, games=self.totals[0], wins=self.totals[1]))
+		else:
+			totals.games += self.totals[0]
+			totals.wins += self.totals[1]
+
+		rows = self.get_rows(PlayerHeroLane, "lane", self.hero_lanes)
+		for (hero_id, lane), stats in self.hero_lanes.items():
+			row = rows.get((hero_id, lane))
+			if row is None:
+				if stats[0] > 0:
+					self.session.add(PlayerHeroLane(account_id=self.account_id, hero_id=hero_id, lane=lane,
+						games=stats[0], wins=stats[1], kills=stats[2], deaths=stats[3], assists=stats[4], last_played=stats[5]))
+			elif row.games + stats[0] <= 0:
+				self.session.delete(row)
+			else:
+				row.games += stats[0]
+				row.wins += stats[1]
+				row.kills += stats[2]
+				row.deaths += stats[3]
+				row.assists += stats[4]
+				row.last_played = max(row.last_played, stats[5])
+
+		rows = self.get_rows(PlayerHeroDay, "day", self.hero_days)
+		for (hero_id, day), games in self.hero_days.items():
+			row = rows.get((hero_id, day))
+			if row is None:
+				if games > 0:
+					self.session.add(PlayerHeroDay(account_id=self.account_id, hero_id=hero_id, day=day, games=games))
+			elif row.games + games <= 0:
+				self.session.delete(row)
+			else:
+				row.games += games
+
+		if self.rebuild_gaps:
+			self.session.query(PlayerGap).filter(PlayerGap.account_id == self.account_id).delete()
+		for start_time, delta in self.gaps.items():
+			self.session.merge(PlayerGap(account_id=self.account_id, start_time=start_time, delta=delta))
+
+
+#
+# How each hero has done against and with each other hero, over all of the matches in the store
+#
+
+class HeroMatchup(Base):
+	__tablename__ = 'hero_matchups'
+
+	hero_id = Column(Integer, primary_key=True)
+	other_hero_id = Column(Integer, primary_key=True)
+	games_against = Column(Integer)
+	wins_against = Column(Integer)
+	games_with = Column(Integer)
+	wins_with = Column(Integer)
+
+matchup_fields = [ "games_against", "wins_against", "games_with", "wins_with" ]
+
+# a match that has been counted in the hero_matchups
+class MatchupMatch(Base):
+	__tablename__ = 'matchup_matches'
+
+	match_id = Column(Integer, primary_key=True)
+
+# the (hero_id, is_radiant) of each player in the match, or an empty list if the match can't be counted in the matchups
+def matchup_players(match):
+	if match.get("radiant_win") is None:
+		return []
+	def is_radiant(player):
+		if player.get("isRadiant") is not None:
+			return bool(player["isRadiant"])
+		return (player.get("player_slot") or 0) < 128
+	return [ (p["hero_id"], is_radiant(p)) for p in match.get("players") or [] if p.get("hero_id") ]
+
+class MatchupMatrix:
+	"""The games and wins for every pair of heroes, kept in one flat array of ints
+
+	Each pair of hero ids has a cell for each of the matchup_fields, and the wins are those of the first hero of the pair"""
+	def __init__(self, size=160):
+		self.size = size
+		self.cells = array("l", [ 0 ]) * (size * size * len(matchup_fields))
+
+	def index(self, hero_id, other_hero_id):
+		return (hero_id * self.size + other_hero_id) * len(matchup_fields)
+
+	# makes room for hero ids up to size, for when new heroes come out
+	def grow(self, size):
+		old_size, old_cells = self.size, self.cells
+		self.__init__(size)
+		for hero_id in range(old_size):
+			i = hero_id * old_size * len(matchup_fields)
+			j = self.index(hero_id, 0)
+			self.cells[j:j + old_size * len(matchup_fields)] = old_cells[i:i + old_size * len(matchup_fields)]
+
+	def set(self, hero_id, other_hero_id, values):
+		if max(hero_id, other_hero_id) >= self.size:
+			self.grow(max(hero_id, other_hero_id) * 2)
+		i = self.index(hero_id, other_hero_id)
+		self.cells[i:i + len(matchup_fields)] = array("l", values)
+
+	def get(self, hero_id, other_hero_id):
+		if max(hero_id, other_hero_id) >= self.size:
+			return dict.fromkeys(matchup_fields, 0)
+		i = self.index(hero_id, other_hero_id)
+		return dict(zip(matchup_fields, self.cells[i:i + len(matchup_fields)]))
+
+	# adds the match's players (from matchup_players) to the matrix, or takes them out if sign is -1
+	# returns the pairs of hero ids that changed
+	def add(self, players, radiant_win, sign=1):
+		if players and max(hero_id for hero_id, is_radiant in players) >= self.size:
+			self.grow(max(hero_id for hero_id, is_radiant in players) * 2)
+		changed = []
+		for hero_id, is_radiant in players:
+			win = sign if is_radiant == radiant_win else 0
+			for other_hero_id, other_is_radiant in players:
+				if other_hero_id == hero_id:
+					continue
+				i = self.index(hero_id, other_hero_id) + (2 if is_radiant == other_is_radiant else 0)
+				self.cells[i] += sign
+				self.cells[i + 1] += win
+				changed.append((hero_id, other_hero_id))
+		return changed
+
+
+# picks out the values for the table's columns from a json object, leaving out any that aren't there
+def pick_columns(table, data, **extra):
+	values = { column.name: data.get(column.name) for column in table.__table__.columns if column.name in data }
+	values.update(extra)
+	return values
+
+class MatchStore:
+	"""The tables of the matches that have been gotten from opendota
+
+	The methods block while sqlite works, so the bot calls them through run, which does them on the store's own thread.
+	There is only the one thread, so writes never wait on each other and the matchups are only ever changed from it.
+
+	registered is the set of steam32 ids of the players whose matches count in the matchups"""
+	def __init__(self, filename, registered):
+		engine = create_engine('sqlite:///' + filename)
+		Base.metadata.create_all(engine)
+		self.add_history_columns(engine)
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="matchstore")
+		self.session = scoped_session(sessionmaker(bind=engine))
+		self.load_matchups(registered)
+		self.session.remove()
+
+	# runs func(*args) on the store's thread, where func is one of the store's methods
+	async def run(self, func, *args):
+		def run():
+			try:
+				return func(*args)
+			except:
+				self.session.rollback()
+				raise
+		return await asyncio.get_event_loop().run_in_executor(self.executor, run)
+
+	# adds any columns that have been added to the history since the store was made
+	# the histories are then fetched in full again the next time they're synced, so the new columns get filled in
+	def add_history_columns(self, engine):
+		with engine.begin() as connection:
+			existing = [ row[1] for row in connection.execute(text("PRAGMA table_info(player_history)")) ]
+			missing = [ column for column in HistoryMatch.__table__.columns if column.name not in existing ]
+			for column in missing:
+				print(f"Adding {column.name} column to player_history")
+				connection.execute(text(f"ALTER TABLE player_history ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+			if missing:
+				connection.execute(text("UPDATE history_syncs SET latest_start_time = NULL"))
+
+	# loads the matchup matrix from its table, building it from the stored matches if the store was made before we kept it,
+	# or before we only counted the matches of registered players
+	def load_matchups(self, registered):
+		self.matchups = MatchupMatrix()
+		if not self.session.query(MatchupMatch.match_id).first():
+			if self.session.query(Match.match_id).first():
+				self.build_matchups(registered)
+			return
+		for row in self.session.query(HeroMatchup):
+			self.matchups.set(row.hero_id, row.other_hero_id, [ getattr(row, field) for field in matchup_fields ])
+
+	def build_matchups(self, registered):
+		print("Building hero matchups from the stored matches")
+		match_ids = set(match_id for match_id, account_id in self.session.query(MatchPlayer.match_id, MatchPlayer.account_id) if account_id in registered)
+		self.session.query(HeroMatchup).delete()
+		changed = set()
+		for match_id, radiant_win in self.session.query(Match.match_id, Match.radiant_win):
+			if match_id in match_ids:
+				changed.update(self.matchups.add(self.get_matchup_players(match_id, radiant_win), radiant_win))
+		if match_ids:
+			self.session.execute(MatchupMatch.__table__.insert(), [ { "match_id": match_id } for match_id in match_ids ])
+		self.save_matchups(changed)
+		self.session.commit()
+
+	# writes the changed pairs in one statement, as a match touches about 90 of them
+	def save_matchups(self, pairs):
+		rows = [ dict(self.matchups.get(hero_id, other_hero_id), hero_id=hero_id, other_hero_id=other_hero_id) for hero_id, other_hero_id in pairs ]
+		if rows:
+			self.session.execute(HeroMatchup.__table__.insert().prefix_with("OR REPLACE"), rows)
+
+	# the matchup_players of a match that is already in the store
+	def get_matchup_players(self, match_id, radiant_win):
+		query = self.session.query(MatchPlayer.hero_id, MatchPlayer.isRadiant, MatchPlayer.player_slot).filter(MatchPlayer.match_id == match_id)
+		players = [ { "hero_id": hero_id, "isRadiant": is_radiant, "player_slot": player_slot } for hero_id, is_radiant, player_slot in query ]
+		return matchup_players({ "radiant_win": radiant_win, "players": players })
+
+	# gets the games and wins of the hero against and with the other hero, over the stored matches of registered players
+	def get_matchup(self, hero_id, other_hero_id):
+		return self.matchups.get(hero_id, other_hero_id)
+
+	# adds the match json from opendota to the store, replacing it if it is already there
+	# it is counted in the matchups if one of the registered steam32 ids played in it
+	def add_match(self, match, registered):
+		match_id = match["match_id"]
+		changed = set()
+		if self.session.query(MatchupMatch.match_id).filter(MatchupMatch.match_id == match_id).first():
+			old_radiant_win = self.session.query(Match.radiant_win).filter(Match.match_id == match_id).scalar()
+			changed.update(self.matchups.add(self.get_matchup_players(match_id, old_radiant_win), old_radiant_win, -1))
+			self.session.query(MatchupMatch).filter(MatchupMatch.match_id == match_id).delete()
+		if any(player.get("account_id") in registered for player in match.get("players") or []):
+			changed.update(self.matchups.add(matchup_players(match), match.get("radiant_win")))
+			self.session.add(MatchupMatch(match_id=match_id))
+		self.save_matchups(changed)
+
+		for table in [ Match, MatchPlayer, ChatMessage ]:
+			self.session.query(table).filter(table.match_id == match_id).delete()
+
+		self.session.add(Match(**pick_columns(Match, match)))
+		players = match.get("players", [])
+		for player in players:
+			party_size = len([ p for p in players if p.get("party_id") == player.get("party_id") ])
+			self.session.add(MatchPlayer(**pick_columns(MatchPlayer, player, match_id=match_id, party_size=party_size)))
+		for i, message in enumerate(match.get("chat") or []):
+			self.session.add(ChatMessage(**pick_columns(ChatMessage, message, match_id=match_id, index=i)))
+		self.session.commit()
+
+	def has_match(self, match_id, parsed=False):
+		query = self.session.query(Match.match_id).filter(Match.match_id == match_id)
+		if parsed:
+			query = query.filter(Match.version != None)
+		return query.first() is not None
+
+	# gets the given columns for a player in each of the given matches, as dicts in the same order as the match ids
+	# columns can be from either the Match or MatchPlayer tables, given by name
+	def get_player_matches(self, account_id, match_ids, columns):
+		query = self.session.query(MatchPlayer.match_id, *self.get_columns(columns))
+		query = query.join(Match, Match.match_id == MatchPlayer.match_id)
+		query = query.filter(MatchPlayer.account_id == account_id, MatchPlayer.match_id.in_(match_ids))
+		rows = { row[0]: dict(zip(columns, row[1:])) for row in query }
+		return [ rows[match_id] for match_id in match_ids if match_id in rows ]
+
+	def get_player(self, account_id, match_id, columns):
+		result = self.get_player_matches(account_id, [ match_id ], columns)
+		return result[0] if result else None
+
+	# gets the chat messages that the player sent in each of the given matches, as (match_id, type, key) in the order they were sent
+	def get_player_chat(self, account_id, match_ids):
+		query = self.session.query(ChatMessage.match_id, ChatMessage.type, ChatMessage.key)
+		query = query.join(MatchPlayer, (MatchPlayer.match_id == ChatMessage.match_id) & (MatchPlayer.player_slot == ChatMessage.player_slot))
+		query = query.filter(MatchPlayer.account_id == account_id, ChatMessage.match_id.in_(match_ids))
+		messages = {}
+		for match_id, type, key in query.order_by(ChatMessage.index):
+			messages.setdefault(match_id, []).append((match_id, type, key))
+		return [ message for match_id in match_ids for message in messages.get(match_id, []) ]
+
+	# gets the match with the given player columns for each player, in the same shape as the match json from opendota
+	def get_match(self, match_id, player_columns):
+		match = self.session.query(Match).filter(Match.match_id == match_id).first()
+		if match is None:
+			return None
+		result = { column.name: getattr(match, column.name) for column in Match.__table__.columns }
+		query = self.session.query(*self.get_columns(player_columns)).filter(MatchPlayer.match_id == match_id).order_by(MatchPlayer.player_slot)
+		# leave out missing values, so that things like player.get("personaname", "Anonymous") work like they do on the json
+		result["players"] = [ { key: value for key, value in zip(player_columns, row) if value is not None } for row in query ]
+		return result
+
+	# gets the (synced_at, latest_start_time) of the player's history, or None if it hasn't been synced yet
+	def get_history_sync(self, account_id):
+		sync = self.session.query(HistorySync).filter(HistorySync.account_id == account_id).first()
+		if sync is None:
+			return None
+		return sync.synced_at, sync.latest_start_time
+
+	def get_latest_start_time(self, account_id):
+		latest = self.session.query(HistoryMatch.start_time).filter(HistoryMatch.account_id == account_id).order_by(HistoryMatch.start_time.desc()).first()
+		return latest[0] if latest else None
+
+	# adds the matches to the player's history, replacing any that were already there, and updates the player's rollups
+	def add_history(self, account_id, matches, synced_at):
+		rows = [ { field: match.get(field) for field in history_fields } for match in matches ]
+		for row in rows:
+			row["account_id"] = account_id
+
+		previous_latest = self.get_latest_start_time(account_id)
+		existing = {}
+		match_ids = [ row["match_id"] for row in rows ]
+		for i in range(0, len(match_ids), 500): # sqlite has a limit on the number of parameters in a query
+			query = self.session.query(*[ getattr(HistoryMatch, field) for field in history_fields ])
+			for values in query.filter(HistoryMatch.account_id == account_id, HistoryMatch.match_id.in_(match_ids[i:i + 500])):
+				existing[values[0]] = dict(zip(history_fields, values))
+
+		if rows:
+			self.session.execute(HistoryMatch.__table__.insert().prefix_with("OR REPLACE"), rows)
+
+		new_rows = [ row for row in rows if row["match_id"] not in existing ]
+		if previous_latest is not None and not PlayerAggregates.exist(self.session, account_id):
+			# the history was stored before we kept rollups of it, so build them from all of it
+			aggregates = PlayerAggregates(self.session, account_id, rebuild=True)
+			all_rows = self.get_history(account_id, history_fields)
+			for row in all_rows:
+				aggregates.add(row)
+			aggregates.add_gaps(all_rows, None)
+		else:
+			aggregates = PlayerAggregates(self.session, account_id)
+			for row in existing.values():
+				aggregates.add(row, -1)
+			for row in rows:
+				aggregates.add(row)
+			if new_rows and (previous_latest is None or min(row["start_time"] for row in new_rows) > previous_latest):
+				aggregates.add_gaps(new_rows, previous_latest)
+			elif new_rows:
+				# some of the new matches are older than ones we already had, so the gaps have to be found again
+				aggregates.rebuild_gaps = True
+				aggregates.add_gaps(self.get_history(account_id, [ "start_time", "duration" ]), None)
+		aggregates.save()
+
+		self.session.merge(HistorySync(
+			account_id=account_id,
+			synced_at=synced_at,
+			latest_start_time=self.get_latest_start_time(account_id)))
+		self.session.commit()
+
+	# gets the number of games the player has played and won
+	def get_player_totals(self, account_id):
+		totals = self.session.query(PlayerTotals).filter(PlayerTotals.account_id == account_id).first()
+		if totals is None:
+			return 0, 0
+		return totals.games, totals.wins
+
+	# gets the player's (hero_id, games) for each hero they've played, most played first
+	# if since is given, only counts games played on or after the day of that time
+	def get_hero_counts(self, account_id, since=None):
+		if since is None:
+			query = self.session.query(PlayerHeroLane.hero_id, func.sum(PlayerHeroLane.games), func.max(PlayerHeroLane.last_played))
+			query = query.filter(PlayerHeroLane.account_id == account_id).group_by(PlayerHeroLane.hero_id)
+		else:
+			query = self.session.query(PlayerHeroDay.hero_id, func.sum(PlayerHeroDay.games), func.max(PlayerHeroDay.day))
+			query = query.filter(PlayerHeroDay.account_id == account_id, PlayerHeroDay.day >= since // 86400).group_by(PlayerHeroDay.hero_id)
+		# ties go to the hero that was played most recently
+		rows = sorted(query, key=lambda row: (row[1], row[2]), reverse=True)
+		return [ (hero_id, games) for hero_id, games, last in rows ]
+
+	# gets the player's totals for the hero in each lane, as a dict of lane -> dict of totals
+	def get_hero_lanes(self, account_id, hero_id):
+		query = self.session.query(PlayerHeroLane).filter(PlayerHeroLane.account_id == account_id, PlayerHeroLane.hero_id == hero_id)
+		result = {}
+		for row in query:
+			result[row.lane] = { "games": row.games, "wins": row.wins, "kills": row.kills, "deaths": row.deaths, "assists": row.assists }
+		return result
+
+	# gets the average gap between the player's groups of games, or None if there aren't any
+	# if since is given, only counts the gaps before groups that started after that time
+	def get_average_gap(self, account_id, since=None):
+		query = self.session.query(func.avg(PlayerGap.delta)).filter(PlayerGap.account_id == account_id)
+		if since is not None:
+			query = query.filter(PlayerGap.start_time > since)
+		return query.scalar()
+
+	# gets the totals and averages of each of the players' matches that started on or after since
+	# returns a dict of account_id -> dict of games, wins, kills, deaths, assists, gold_per_min, xp_per_min and last_hits
+	# the averages leave out matches where opendota doesn't have the value, and are None if it has none of them
+	def get_recent_stats(self, account_ids, since):
+		win = (HistoryMatch.player_slot < 128) == HistoryMatch.radiant_win
+		fields = [ "games", "wins", "kills", "deaths", "assists", "gold_per_min", "xp_per_min", "last_hits" ]
+		query = self.session.query(HistoryMatch.account_id, func.count(), func.sum(win, type_=Integer),
+			*[ func.avg(getattr(HistoryMatch, field)) for field in fields[2:] ])
+		query = query.filter(HistoryMatch.account_id.in_(account_ids), HistoryMatch.start_time >= since)
+		query = query.group_by(HistoryMatch.account_id)
+		return { row[0]: dict(zip(fields, row[1:])) for row in query }
+
+	# gets the given columns of the matches in the player's history as dicts, most recent first
+	def get_history(self, account_id, columns, hero_id=None):
+		query = self.session.query(*[ getattr(HistoryMatch, column) for column in columns ]).filter(HistoryMatch.account_id == account_id)
+		if hero_id is not None:
+			query = query.filter(HistoryMatch.hero_id == hero_id)
+		query = query.order_by(HistoryMatch.start_time.desc())
+		return [ dict(zip(columns, row)) for row in query ]
+
+	def get_columns(self, names):
+		result = []
+		for name in names:
+			if name in MatchPlayer.__table__.columns:
+				result.append(getattr(MatchPlayer, name))
+			else:
+				result.append(getattr(Match, name))
+		return result
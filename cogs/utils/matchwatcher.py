@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+class WatchEntry():
+	"""The latest match we know of for a player, and whatever was prepared for it"""
+	def __init__(self, match_id, data, first_seen=None):
+		self.match_id = match_id
+		self.data = data
+		self.checked = time.time()
+		self.first_seen = first_seen or self.checked
+
+class MatchWatcher():
+	"""Watches for new matches from a set of players, and prepares things for each new match before anyone asks for them
+
+	Each player is checked at most once per interval, and the checks are spread out over the interval so they don't all go at once.
+	Only one player is checked at a time, to keep the load on opendota low
+
+	Data that isn't done yet (like the stats of a match that isn't parsed yet) is prepared again on each check,
+	until it is done or it has been redo_time seconds since the match was first seen"""
+	def __init__(self, get_watched, get_latest_match, prepare, is_done, interval=60 * 5, redo_time=60 * 60):
+		self.get_watched = get_watched # () -> list of steam32 ids to watch
+		self.get_latest_match = get_latest_match # async (steam32) -> match_id of their latest match
+		self.prepare = prepare # async (steam32, match_id) -> the data to keep for the match
+		self.is_done = is_done # (data) -> whether the data won't change if it is prepared again
+		self.interval = interval
+		self.redo_time = redo_time
+		self.entries = {} # steam32 -> WatchEntry
+
+	# the prepared data for the given match of the player, if we have it and it is done
+	def get(self, steam32, match_id):
+		entry = self.entries.get(steam32)
+		if entry is not None and entry.match_id == match_id and self.is_done(entry.data):
+			return entry.data
+		return None
+
+	# keeps data that was prepared somewhere else, like from a command that just did the work itself
+	def put(self, steam32, match_id, data):
+		entry = self.entries.get(steam32)
+		first_seen = entry.first_seen if entry is not None and entry.match_id == match_id else None
+		self.entries[steam32] = WatchEntry(match_id, data, first_seen)
+
+	async def check(self, steam32):
+		match_id = await self.get_latest_match(steam32)
+		entry = self.entries.get(steam32)
+		if entry is not None and entry.match_id == match_id:
+			if self.is_done(entry.data) or time.time() - entry.first_seen >= self.redo_time:
+				entry.checked = time.time()
+				return
+		self.put(steam32, match_id, await self.prepare(steam32, match_id))
+
+	async def run(self):
+		while True:
+			start = time.time()
+			watched = self.get_watched()
+			for steam32 in list(self.entries):
+				if steam32 not in watched:
+					del self.entries[steam32]
+			spacing = self.interval / max(len(watched), 1)
+			for i, steam32 in enumerate(watched):
+				entry = self.entries.get(steam32)
+				# skip players who were checked recently anyway, like by a command
+				if entry is None or time.time() - entry.checked >= self.interval / 2:
+					try:
+						await self.check(steam32)
+					except asyncio.CancelledError:
+						raise
+					except Exception as e:
+						print(f"watching matches of {steam32} failed: {e}")
+				await asyncio.sleep(max(0, start + spacing * (i + 1) - time.time()))
+			await asyncio.sleep(max(0, start + self.interval - time.time()))
@@ -0,0 +1,76 @@
+import sqlite3
+import time
+
+#
+# Copies a read-only sqlite database (like dotabase) into memory, so queries don't have to go to the disk
+# The benchmark compares query latency against the file, run from the repo root with:
+# python3.6 -m cogs.utils.memorydb
+#
+
+# the indexes for the columns we filter responses by. heroes.id is the primary key, so it already has one
+dotabase_indexes = [
+	("responses", "name"),
+	("responses", "hero_id"),
+	("responses", "text_simple")
+]
+
+class MemoryDatabase:
+	"""An in-memory copy of a sqlite database file
+
+	The copy is a named shared-cache memory database, so each thread can open its own connection to it.
+	It only exists while at least one connection is open, so this keeps one open for as long as it's around"""
+	def __init__(self, filename, name, indexes=[]):
+		self.uri = f"file:{name}?mode=memory&cache=shared"
+		start = time.perf_counter()
+		self.connection = self.connect()
+		source = sqlite3.connect(filename)
+		if hasattr(source, "backup"):
+			source.backup(self.connection)
+		else: # the backup api was only added in python 3.7
+			self.connection.executescript("\n".join(source.iterdump()))
+		source.close()
+		for table, column in indexes:
+			self.connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})")
+		self.connection.commit()
+		self.load_time = time.perf_counter() - start
+
+	# opens a new connection to the copy. can be given to sqlalchemy's create_engine as the creator
+	def connect(self):
+		return sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+	def close(self):
+		self.connection.close()
+
+
+# times running each query many times on the given connection, returning the average time of each in ms
+def time_queries(connection, queries, repeat=200):
+	result = []
+	for query, args in queries:
+		start = time.perf_counter()
+		for i in range(repeat):
+			connection.execute(query, args).fetchall()
+		result.append((time.perf_counter() - start) * 1000 / repeat)
+	return result
+
+def benchmark(filename):
+	disk = sqlite3.connect(filename)
+	memory = MemoryDatabase(filename, "dotabase_benchmark", dotabase_indexes)
+	print(f"copied to memory in {memory.load_time * 1000:.0f}ms")
+
+	name, hero_id, text_simple = disk.execute("SELECT name, hero_id, text_simple FROM responses LIMIT 1").fetchone()
+	queries = [
+		("SELECT * FROM responses WHERE name = ?", (name,)),
+		("SELECT * FROM responses WHERE hero_id = ?", (hero_id,)),
+		("SELECT * FROM responses WHERE text_simple = ?", (text_simple,)),
+		("SELECT * FROM heroes WHERE id = ?", (hero_id,))
+	]
+	disk_times = time_queries(disk, queries)
+	memory_times = time_queries(memory.connection, queries)
+	for (query, args), disk_time, memory_time in zip(queries, disk_times, memory_times):
+		print(f"{query}: disk {disk_time:.3f}ms, memory {memory_time:.3f}ms")
+	disk.close()
+	memory.close()
+
+if __name__ == '__main__':
+	from dotabase import dotabase_db
+	benchmark(dotabase_db)
@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+class ParseJob():
+	"""A parse that we've requested from opendota and are waiting on"""
+	def __init__(self, match_id, loop):
+		self.match_id = match_id
+		self.job_id = None # set once the request has gone through
+		self.future = loop.create_future()
+		self.started = time.time()
+		self.interval = None
+		self.next_check = None
+
+class ParseTracker():
+	"""Keeps track of all of the parse jobs that have been requested, and polls them from a single task
+
+	Requesting a match that is already being parsed just waits on the existing job.
+	Each job is checked often at first, and then less often the longer it takes"""
+	def __init__(self, loop, request_parse, check_job, on_parsed, min_interval=3, max_interval=30, timeout=60 * 60):
+		self.loop = loop
+		self.request_parse = request_parse # async (match_id) -> job_id
+		self.check_job = check_job # async (job_id) -> True if the job is done
+		self.on_parsed = on_parsed # async (match_id), called when a match finishes parsing
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.timeout = timeout
+		self.jobs = {} # match_id -> ParseJob
+		self.wakeup = asyncio.Event(loop=loop)
+		self.task = None
+
+	# requests a parse of the match, and waits for it to finish
+	async def parse(self, match_id):
+		job = self.jobs.get(match_id)
+		if job is None:
+			job = ParseJob(match_id, self.loop)
+			self.jobs[match_id] = job
+			try:
+				job.job_id = await self.request_parse(match_id)
+			except Exception as e:
+				del self.jobs[match_id]
+				job.future.set_exception(e)
+				job.future.exception() # so it doesnt complain about the exception never being retrieved
+				raise
+			job.interval = self.min_interval
+			job.next_check = time.time() + job.interval
+			if self.task is None or self.task.done():
+				self.task = self.loop.create_task(self.poll_task())
+			self.wakeup.set()
+		return await asyncio.shield(job.future)
+
+	async def poll_task(self):
+		while self.jobs:
+			waiting = [ job for job in self.jobs.values() if job.next_check is not None ]
+			delay = min([ job.next_check for job in waiting ], default=time.time() + self.min_interval) - time.time()
+			self.wakeup.clear()
+			try:
+				await asyncio.wait_for(self.wakeup.wait(), max(0, delay))
+				continue # a new job was added, so figure out how long to wait again
+			except asyncio.TimeoutError:
+				pass
+
+			now = time.time()
+			due = [ job for job in waiting if job.next_check <= now ]
+			results = await asyncio.gather(*[ self.check_job(job.job_id) for job in due ], return_exceptions=True)
+			for job, done in zip(due, results):
+				if isinstance(done, Exception):
+					print(f"checking parse of match {job.match_id} failed: {done}")
+					done = False
+				if done:
+					del self.jobs[job.match_id]
+					try:
+						await self.on_parsed(job.match_id)
+					except Exception as e:
+						print(f"handling parsed match {job.match_id} failed: {e}")
+					job.future.set_result(True)
+				elif now - job.started > self.timeout:
+					del self.jobs[job.match_id]
+					job.future.set_exception(asyncio.TimeoutError())
+					job.future.exception()
+				else:
+					job.interval = min(self.max_interval, job.interval * 1.5)
+					job.next_check = now + job.interval
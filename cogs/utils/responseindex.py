@@ -0,0 +1,130 @@
+# Bitmaps are python ints, where bit n is set if row n is included
+
+def rows_to_bits(rows):
+	if not rows:
+		return 0
+	data = bytearray((max(rows) >> 3) + 1)
+	for row in rows:
+		data[row >> 3] |= 1 << (row & 7)
+	return int.from_bytes(data, "little")
+
+def bits_to_rows(bits):
+	bitstring = bin(bits)[:1:-1] # reversed so that the index of each char is its row
+	rows = []
+	row = bitstring.find("1")
+	while row != -1:
+		rows.append(row)
+		row = bitstring.find("1", row + 1)
+	return rows
+
+def count_bits(bits):
+	return bin(bits).count("1")
+
+
+class ResponseIndex:
+	"""An in-memory index of the dota responses, for finding responses by name or text without scanning the Response table
+
+	Responses are referred to by their row, which is their position in the index.
+	Each hero and each of the given criteria values has a bitmap of its rows, so filtering by hero and criteria is
+	just and-ing the bitmaps together. The decoded rows for each filter are cached, so picking a random response
+	for one of them is just a random.choice"""
+	def __init__(self, responses, criteria_values=[]):
+		self.names = []
+		self.texts = []
+		self.hero_ids = []
+		self.criteria = []
+		self.name_rows = {} # name -> row
+		self.text_rows = {} # text_simple -> [ row, ... ]
+		self.word_rows = {} # word -> set of rows with that word in their text
+		criteria_values = set(c.lower() for c in criteria_values)
+		criteria_lengths = set(map(len, criteria_values))
+		hero_rows = {}
+		criteria_rows = { value: [] for value in criteria_values }
+		for name, text_simple, hero_id, criteria in responses:
+			row = len(self.names)
+			self.names.append(name)
+			self.texts.append(text_simple)
+			self.hero_ids.append(hero_id)
+			self.criteria.append((criteria or "").lower())
+			self.name_rows.setdefault(name, row)
+			self.text_rows.setdefault(text_simple, []).append(row)
+			for word in set(text_simple.split()):
+				self.word_rows.setdefault(word, set()).add(row)
+			hero_rows.setdefault(hero_id, []).append(row)
+			for value in self.matching_criteria(self.criteria[row], criteria_values, criteria_lengths):
+				criteria_rows[value].append(row)
+
+		self.all_bits = (1 << len(self.names)) - 1
+		self.hero_bits = { hero_id: rows_to_bits(rows) for hero_id, rows in hero_rows.items() }
+		self.criteria_bits = { value: rows_to_bits(rows) for value, rows in criteria_rows.items() }
+		self.rows_cache = {} # (hero_id, criteria) -> [ row, ... ]
+
+	# the criteria values that match the criteria of a response, which is any value that one of the '|' separated parts starts with
+	# this is the same as the "criteria LIKE 'x%' OR criteria LIKE '%|x%'" filter used on the Response table
+	@staticmethod
+	def matching_criteria(criteria, criteria_values, criteria_lengths):
+		result = set()
+		for part in criteria.split("|"):
+			for length in criteria_lengths:
+				if part[:length] in criteria_values:
+					result.add(part[:length])
+		return result
+
+	def __len__(self):
+		return len(self.names)
+
+	def find_name(self, name):
+		row = self.name_rows.get(name)
+		return [] if row is None else [ row ]
+
+	def find_text(self, text_simple):
+		return list(self.text_rows.get(text_simple, []))
+
+	# finds all the responses which have the given simplified phrase in their text, best matches first
+	# the simplified texts are padded with spaces, so every match is of whole words. responses that start with the phrase
+	# come first, and then responses that are more made up of the phrase (shorter ones) come before ones where it is a small part
+	def search(self, text_simple):
+		words = text_simple.split()
+		if not words:
+			return []
+		postings = sorted((self.word_rows.get(word, set()) for word in set(words)), key=len)
+		rows = set(postings[0])
+		for posting in postings[1:]:
+			rows &= posting
+		rows = [ row for row in rows if text_simple in self.texts[row] ]
+		rows.sort(key=lambda row: (not self.texts[row].startswith(text_simple), len(self.texts[row]), row))
+		return rows
+
+	# the bitmap of the rows for the given hero and/or criteria
+	def get_bits(self, hero_id=None, criteria=None):
+		bits = self.all_bits
+		if hero_id is not None:
+			bits &= self.hero_bits.get(hero_id, 0)
+		if criteria is not None:
+			key = criteria.lower()
+			if key not in self.criteria_bits:
+				# not one of the criteria we know about, so figure it out the slow way
+				rows = [ row for row in range(len(self)) if self.matching_criteria(self.criteria[row], { key }, { len(key) }) ]
+				self.criteria_bits[key] = rows_to_bits(rows)
+			bits &= self.criteria_bits[key]
+		return bits
+
+	# gets all of the rows for the given hero and/or criteria
+	def get_rows(self, hero_id=None, criteria=None):
+		key = (hero_id, criteria.lower() if criteria is not None else None)
+		if key not in self.rows_cache:
+			self.rows_cache[key] = bits_to_rows(self.get_bits(hero_id, criteria))
+		return self.rows_cache[key]
+
+	def count(self, hero_id=None, criteria=None):
+		return count_bits(self.get_bits(hero_id, criteria))
+
+	# returns the rows that are for the given hero and have the given criteria, if they are specified, keeping their order
+	def filter(self, rows, hero_id=None, criteria=None):
+		if hero_id is None and criteria is None:
+			return rows
+		bits = self.get_bits(hero_id, criteria)
+		return [ row for row in rows if (bits >> row) & 1 ]
+
+	def get_names(self, rows):
+		return [ self.names[row] for row in rows ]
@@ -11,7 +11,7 @@ from collections import OrderedDict
 class Settings:
 	def __init__(self):
 		self.path = "settings.json"
-		self.defaults = OrderedDict([  ("token", ""), ("ttslang", "en-au"), ("error_logging", False), ("debug", False) ])
+		self.defaults = OrderedDict([  ("token", ""), ("ttslang", "en-au"), ("error_logging", False), ("debug", False), ("dotabase_in_memory", True) ])
 		if not os.path.exists(self.path):
 			self.json_data = self.defaults
 			self.save_settings()
@@ -43,6 +43,10 @@ class Settings:
 	@property
 	def debug(self):
 	    return self.json_data.get("debug", False)
+
+	@property
+	def dotabase_in_memory(self):
+		return self.json_data.get("dotabase_in_memory", True)
 	
 
 	def resource(self, dir):
@@ -7,6 +7,7 @@ import cogs.utils.loggingdb as loggingdb
 import traceback
 import asyncio
 import string
+import time
 from discord.ext import commands
 import logging
 
@@ -28,6 +29,7 @@ permissions = 314432
 bot = commands.Bot(command_prefix='!', formatter=MangoHelpFormatter(), description=description)
 bot.remove_command("help")
 thinker = Thinker(bot)
+loop_monitor = LoopMonitor(bot)
 invite_link = f"https://discordapp.com/oauth2/authorize?permissions={permissions}&scope=bot&client_id=213476188037971968"
 
 deprecated_commands = {
@@ -36,6 +38,10 @@ deprecated_commands = {
 	"opendotasql": "https://www.opendota.com/explorer"
 }
 
+# how many guilds we reconnect voice/update nicknames for at once on startup, so we dont hit discord's rate limits
+startup_concurrency = 5
+voice_connect_timeout = 20
+
 @bot.event
 async def on_ready():
 	print('Logged in as:\n{0} (ID: {0.id})'.format(bot.user))
@@ -44,24 +50,50 @@ async def on_ready():
 	await bot.change_presence(game=discord.Game(name="DOTA 3 [?help]", url="http://github.com/mdiller/MangoByte"))
 	cog = bot.get_cog("Audio")
 
-	for guildinfo in botdata.guildinfo_list():
-		if guildinfo.voicechannel is not None:
+	start_time = time.time()
+	semaphore = asyncio.Semaphore(startup_concurrency)
+	guildinfos = [ guildinfo for guildinfo in botdata.guildinfo_list() if guildinfo.voicechannel is not None ]
+	progress = { "done": 0, "connected": 0 }
+
+	async def reconnect_voice(guildinfo):
+		async with semaphore:
 			try:
-				print(f"connecting voice to: {guildinfo.voicechannel}")
-				await cog.connect_voice(guildinfo.voicechannel)
+				await asyncio.wait_for(cog.connect_voice(guildinfo.voicechannel), voice_connect_timeout)
+				progress["connected"] += 1
 			except UserError as e:
 				if e.message == "channel not found":
 					guildinfo.voicechannel = None
 				else:
 					raise
 			except asyncio.TimeoutError:
+				print(f"timed out connecting voice to: {guildinfo.voicechannel}")
 				guildinfo.voicechannel = None
-	
+			finally:
+				progress["done"] += 1
+				print(f"connecting voice: {progress['done']}/{len(guildinfos)}")
+
+	results = await asyncio.gather(*[ reconnect_voice(guildinfo) for guildinfo in guildinfos ], return_exceptions=True)
+	for result in results:
+		if isinstance(result, Exception):
+			print(f"error connecting voice: {''.join(traceback.format_exception(type(result), result, result.__traceback__))}")
+	print(f"connected to {progress['connected']}/{len(guildinfos)} voice channels in {time.time() - start_time:.2f} seconds")
+
 	new_nick = bot.user.name + " v" + get_version()
+
+	async def update_nick(guild):
+		async with semaphore:
+			await guild.me.edit(nick=new_nick)
+
+	guilds = []
 	for guild in bot.guilds:
 		if guild.me.guild_permissions.change_nickname:
 			if guild.me.nick is None or (guild.me.nick.startswith(bot.user.name) and guild.me.nick != new_nick):
-				await guild.me.edit(nick=new_nick)
+				guilds.append(guild)
+	results = await asyncio.gather(*[ update_nick(guild) for guild in guilds ], return_exceptions=True)
+	for result in results:
+		if isinstance(result, Exception):
+			print(f"error updating nickname: {result}")
+	print(f"startup finished in {time.time() - start_time:.2f} seconds")
 
 async def get_cmd_signature(ctx):
 	bot.formatter.context = ctx